@@ -1,25 +1,169 @@
-import subprocess
 import sys
 import os
 import asyncio
 import tempfile
 import json
+import ast
+import codecs
 import traceback
 import signal
+import socket
+import re
+import time
+import shutil
+import base64
+import uuid
+import hashlib
+import heapq
+import sqlite3
+import threading
+import itertools
+import math
+import struct
+import gzip
+import importlib.metadata
+import importlib.util
+from collections import OrderedDict
 import psutil
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Set, Callable, Awaitable
 from datetime import datetime, timedelta
 import logging
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Query
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
+from starlette.datastructures import Headers, MutableHeaders
 import uvicorn
 
+# Optional codecs for response compression and binary response encodings; missing ones are not offered
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Execution engine configuration
+MAX_CONCURRENT_EXECUTIONS = int(os.environ.get("MAX_CONCURRENT_EXECUTIONS", os.cpu_count() or 1))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Streaming execution configuration
+STREAM_MAX_OUTPUT_BYTES = int(os.environ.get("STREAM_MAX_OUTPUT_BYTES", 10 * 1024 * 1024))
+STREAM_QUEUE_SIZE = 64
+MEMORY_SAMPLE_INTERVAL = 0.5
+
+# Stopping executions: SIGTERM to the process group, SIGKILL for whatever is left after the grace period
+KILL_GRACE_SECONDS = float(os.environ.get("KILL_GRACE_SECONDS", 2))
+EXECUTION_ID_PATTERN = "^[0-9a-f]{32}$"
+
+# Output kept in memory per stream; the middle of longer output is dropped or spilled to disk
+MAX_OUTPUT_BYTES = int(os.environ.get("MAX_OUTPUT_BYTES", 1024 * 1024))
+
+# Pre-warmed worker pool configuration (set WORKER_POOL_SIZE=0 to always start a fresh interpreter)
+DEFAULT_WARM_MODULES = [
+    'psutil', 'numpy', 'pandas', 'scipy', 'sklearn',
+    'matplotlib', 'matplotlib.pyplot', 'seaborn', 'plotly'
+]
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", MAX_CONCURRENT_EXECUTIONS)) if hasattr(os, 'fork') else 0
+WORKER_MAX_USES = int(os.environ.get("WORKER_MAX_USES", 50))
+WORKER_WARM_MODULES = [
+    name.strip() for name in os.environ.get("WORKER_WARM_MODULES", ",".join(DEFAULT_WARM_MODULES)).split(",")
+    if name.strip()
+]
+
+# Opt-in cache of execution results keyed on code, options and installed library versions
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", 600))
+
+# Batch execution limits
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 100))
+
+# Stateful sessions: long-lived workers that keep their namespace between executions
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 8))
+SESSION_IDLE_TIMEOUT_SECONDS = int(os.environ.get("SESSION_IDLE_TIMEOUT_SECONDS", 900))
+SESSION_MEMORY_LIMIT_MB = int(os.environ.get("SESSION_MEMORY_LIMIT_MB", 1024))
+
+# Uploaded datasets, stored once per content hash and exposed read-only to executions
+DATASETS_DIR = os.environ.get("DATASETS_DIR", os.path.join(tempfile.gettempdir(), "sandbox-datasets"))
+MAX_DATASET_BYTES = int(os.environ.get("MAX_DATASET_BYTES", 1024 * 1024 * 1024))
+DATASET_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Asynchronous jobs: requests kept in a local SQLite store and run by background workers
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", os.path.join(tempfile.gettempdir(), "sandbox-jobs.sqlite3"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", MAX_CONCURRENT_EXECUTIONS))
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 3600))
+MAX_PENDING_JOBS = int(os.environ.get("MAX_PENDING_JOBS", 1000))
+JOB_MAX_WAIT_SECONDS = 60
+JOB_POLL_INTERVAL = 5
+
+# How long clients may reuse a /libraries response before revalidating it
+LIBRARIES_MAX_AGE_SECONDS = int(os.environ.get("LIBRARIES_MAX_AGE_SECONDS", 3600))
+
+# Rich output (display(), fig.show(), last expression): per-representation size cap and table rows
+RICH_OUTPUT_MAX_BYTES = int(os.environ.get("RICH_OUTPUT_MAX_BYTES", 1024 * 1024))
+RICH_OUTPUT_MAX_ROWS = 50
+
+# Filename the user's code is compiled under, as shown in tracebacks
+USER_CODE_FILENAME = "<user_code>"
+
+# Side channel from the wrapper to the API process: length-prefixed JSON messages on a separate fd
+CHANNEL_FD_ENV = "SANDBOX_CHANNEL_FD"
+CHANNEL_MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+PLOT_FILE_PATTERN = re.compile(r"^plot_[0-9]+\.[a-z]+$")
+
+# Plot artifacts written by executions, served by GET /artifacts/{id}
+ARTIFACTS_DIR = os.environ.get("ARTIFACTS_DIR", os.path.join(tempfile.gettempdir(), "sandbox-artifacts"))
+ARTIFACT_TTL_SECONDS = int(os.environ.get("ARTIFACT_TTL_SECONDS", 3600))
+ARTIFACT_MEDIA_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "log": "text/plain",
+    "collapsed": "text/plain",
+}
+ARTIFACT_ID_PATTERN = re.compile(r"^[0-9a-f]{32}/[A-Za-z0-9_.-]+$")
+
+# Admission control: executions run while a CPU slot is free and their memory_limit_mb fits the
+# budget; the rest wait in a bounded priority queue without blocking the event loop
+EXECUTION_MEMORY_BUDGET_MB = int(os.environ.get(
+    "EXECUTION_MEMORY_BUDGET_MB", psutil.virtual_memory().total * 0.8 // (1024 * 1024)
+))
+MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", MAX_CONCURRENT_EXECUTIONS * 8))
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("QUEUE_TIMEOUT_SECONDS", 30))
+# Requests without an explicit priority are interactive if their timeout is at most this
+INTERACTIVE_TIMEOUT_SECONDS = int(os.environ.get("INTERACTIVE_TIMEOUT_SECONDS", 10))
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1}
+
+# Responses of at least this many bytes are compressed when the client accepts zstd, br or gzip
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+COMPRESSION_MAX_BYTES = 64 * 1024 * 1024
+COMPRESSIBLE_MEDIA_TYPES = ("text/", "application/json", "application/msgpack", "application/x-msgpack", "application/cbor", "image/svg+xml")
+
+# CPU budget per execution: BLAS/OpenMP thread pools are sized to a share of the cores, and
+# with CPU_AFFINITY=1 each execution is also pinned to that many of the least used cores
+CPU_CORES = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+CPU_AFFINITY = os.environ.get("CPU_AFFINITY", "0") == "1" and hasattr(os, 'sched_setaffinity')
+THREAD_COUNT_VARIABLES = [
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"
+]
+
 app = FastAPI(
     title="Code Runner Sandbox",
     description="A secure Python code execution sandbox with data analysis and Google Cloud libraries",
@@ -35,193 +179,1716 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Prometheus-style metrics, rendered by GET /metrics
+class Counter:
+    """A monotonically increasing count, kept here or read from a callback when metrics are scraped."""
+    
+    def __init__(self, name: str, help_text: str, read: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.read = read
+    
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+    
+    def render(self) -> List[str]:
+        value = self.read() if self.read else self.value
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter", f"{self.name} {value}"]
+
+class Gauge:
+    """A gauge whose value is read from a callback when metrics are scraped."""
+    
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: List[float]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+SIZE_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864]
+
+QUEUE_WAIT_SECONDS = Histogram("sandbox_queue_wait_seconds", "Time spent waiting for an execution slot", LATENCY_BUCKETS)
+SPAWN_SECONDS = Histogram("sandbox_spawn_seconds", "Time from starting an execution until the wrapper runs", LATENCY_BUCKETS)
+USER_CODE_SECONDS = Histogram("sandbox_user_code_seconds", "Time spent running user code", LATENCY_BUCKETS)
+PLOT_ENCODE_SECONDS = Histogram("sandbox_plot_encode_seconds", "Time spent rendering figures in the child", LATENCY_BUCKETS)
+OUTPUT_PARSE_SECONDS = Histogram("sandbox_output_parse_seconds", "Time spent turning child output into a response", LATENCY_BUCKETS)
+MEMORY_BUCKETS = [size * 1024 * 1024 for size in (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048)]
+UNIQUE_MEMORY_BYTES = Histogram("sandbox_unique_memory_bytes", "Memory private to an execution process (USS) at the end of the run", MEMORY_BUCKETS)
+RESPONSE_SIZE_BYTES = Histogram("sandbox_response_size_bytes", "Size of execution responses", SIZE_BUCKETS)
+EXECUTIONS_TOTAL = Counter("sandbox_executions_total", "Executions started")
+TIMEOUTS_TOTAL = Counter("sandbox_timeouts_total", "Executions stopped by their timeout")
+SECURITY_REJECTIONS_TOTAL = Counter("sandbox_security_rejections_total", "Submissions rejected by the security check")
+MEMORY_LIMIT_KILLS_TOTAL = Counter("sandbox_memory_limit_exceeded_total", "Executions stopped by their memory limit")
+COMPRESSION_SAVED_BYTES_TOTAL = Counter("sandbox_compression_saved_bytes_total", "Bytes saved on the wire by response compression")
+CPU_SECONDS_TOTAL = Counter("sandbox_cpu_seconds_total", "CPU time used by executions, including their child processes")
+CANCELLATIONS_TOTAL = Counter("sandbox_cancellations_total", "Executions cancelled with DELETE /executions/{id}")
+CLIENT_DISCONNECTS_TOTAL = Counter("sandbox_client_disconnects_total", "Executions cancelled because the client disconnected")
+ORPHANS_KILLED_TOTAL = Counter("sandbox_orphans_killed_total", "Descendant processes that outlived their process group and were killed")
+
+@app.middleware("http")
+async def record_response_size(request: Request, call_next):
+    response = await call_next(request)
+    if request.method == "POST" and request.url.path.rstrip("/").endswith(("/execute", "/execute/batch")):
+        content_length = response.headers.get("content-length")
+        if content_length:
+            RESPONSE_SIZE_BYTES.observe(int(content_length))
+    return response
+
+def parse_quality_list(header: str) -> Dict[str, float]:
+    """Parse an Accept or Accept-Encoding header into {value: q}."""
+    weights = {}
+    for item in header.split(","):
+        value, _, params = item.partition(";")
+        value = value.strip().lower()
+        if not value:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, number = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        weights[value] = quality
+    return weights
+
+# Preferred first; zstd and brotli compress better and faster than gzip at these levels
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {}
+if zstandard:
+    COMPRESSORS["zstd"] = zstandard.ZstdCompressor(level=3).compress
+if brotli:
+    COMPRESSORS["br"] = lambda data: brotli.compress(data, quality=5)
+COMPRESSORS["gzip"] = lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    weights = parse_quality_list(accept_encoding)
+    wildcard = weights.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in COMPRESSORS:
+        quality = weights.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+class CompressionMiddleware:
+    """Compresses complete responses with the best encoding the client accepts.
+    
+    Only responses with a Content-Length between minimum_size and COMPRESSION_MAX_BYTES are
+    compressed; streaming responses (NDJSON, SSE) have none and pass through untouched, as do
+    media types that are already compressed, like PNG.
+    """
+    
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    async def __call__(self, scope, receive, send):
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", "")) if scope["type"] == "http" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start = None
+        chunks: List[bytes] = []
+        
+        async def send_compressed(message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                if not headers.get("content-type", "").startswith(COMPRESSIBLE_MEDIA_TYPES):
+                    await send(message)
+                    return
+                headers.add_vary_header("Accept-Encoding")
+                length = int(headers.get("content-length", -1))
+                if "content-encoding" in headers or not self.minimum_size <= length <= COMPRESSION_MAX_BYTES:
+                    await send(message)
+                    return
+                start = message
+                return
+            if start is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+            # The body may arrive in several chunks (e.g. through the metrics middleware)
+            chunks.append(message.get("body", b""))
+            if message.get("more_body"):
+                return
+            body = b"".join(chunks)
+            # Compressing a few MB takes tens of milliseconds; keep it off the event loop
+            compressed = await asyncio.to_thread(COMPRESSORS[encoding], body)
+            if len(compressed) < len(body):
+                COMPRESSION_SAVED_BYTES_TOTAL.inc(len(body) - len(compressed))
+                headers = MutableHeaders(raw=start["headers"])
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(compressed))
+                body = compressed
+            await send(start)
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+        
+        await self.app(scope, receive, send_compressed)
+
+app.add_middleware(CompressionMiddleware)
+
+# Compact alternatives to JSON, chosen with the Accept header; plots are sent as raw bytes
+BINARY_ENCODERS: Dict[str, Callable[[Any], bytes]] = {}
+if msgpack:
+    BINARY_ENCODERS["application/msgpack"] = msgpack.packb
+    BINARY_ENCODERS["application/x-msgpack"] = msgpack.packb
+if cbor2:
+    BINARY_ENCODERS["application/cbor"] = cbor2.dumps
+
+def negotiate_binary_encoding(accept: str) -> Optional[str]:
+    """Pick a binary media type from the Accept header if the client prefers it at least as much as JSON."""
+    weights = parse_quality_list(accept)
+    json_quality = weights.get("application/json", weights.get("application/*", weights.get("*/*", 0.0)))
+    best, best_quality = None, 0.0
+    for media_type in BINARY_ENCODERS:
+        quality = weights.get(media_type, 0.0)
+        if quality > best_quality and quality >= json_quality:
+            best, best_quality = media_type, quality
+    return best
+
+def encode_response(http_request: Request, response: Any) -> Any:
+    """Serialize an execution response as msgpack or CBOR when the client asked for it.
+    
+    Inline plots are decoded to raw image bytes. Anything else is returned unchanged, for
+    FastAPI to send as JSON.
+    """
+    media_type = negotiate_binary_encoding(http_request.headers.get("accept", ""))
+    if media_type is None or not isinstance(response, BaseModel):
+        return response
+    payload = response.model_dump()
+    for item in payload.get("results") or [payload.get("result") or payload]:
+        if item.get("plots"):
+            item["plots"] = [base64.b64decode(plot) for plot in item["plots"]]
+    return Response(content=BINARY_ENCODERS[media_type](payload), media_type=media_type)
+
 class CodeExecutionRequest(BaseModel):
     code: str = Field(..., description="Python code to execute")
     timeout: int = Field(default=30, description="Execution timeout in seconds", ge=1, le=300)
     memory_limit_mb: int = Field(default=512, description="Memory limit in MB", ge=64, le=2048)
+    plot_format: str = Field(default="png", description="Image format for matplotlib figures", pattern="^(png|svg|webp|jpeg)$")
+    plot_dpi: int = Field(default=150, description="Resolution of rendered figures", ge=25, le=600)
+    plot_max_pixels: Optional[int] = Field(default=None, description="Lower the dpi of raster figures larger than this many pixels", ge=10_000, le=100_000_000)
+    plot_max_bytes: Optional[int] = Field(default=None, description="Re-encode figures larger than this at a lower dpi, or as PNG if they are SVG", ge=1024, le=64 * 1024 * 1024)
+    max_plots: int = Field(default=20, description="Maximum number of figures captured", ge=0, le=100)
+    rich_output: bool = Field(default=True, description="Show the value of a trailing expression in rich_outputs, as a notebook would")
+    max_rich_outputs: int = Field(default=20, description="Maximum number of rich outputs captured", ge=0, le=100)
+    inline_plots: bool = Field(default=True, description="Return plots as base64 in 'plots' instead of artifact references")
+    max_output_bytes: int = Field(default=MAX_OUTPUT_BYTES, description="Bytes of stdout/stderr kept in the response; the middle of longer output is dropped", ge=1024, le=64 * 1024 * 1024)
+    spill_output: bool = Field(default=False, description="Save the full stdout/stderr as artifacts when they are truncated")
+    cache: bool = Field(default=False, description="Reuse the result of an identical earlier execution if one is cached")
+    priority: Optional[str] = Field(default=None, description="Scheduling class; defaults to interactive for short timeouts, batch otherwise", pattern="^(interactive|batch)$")
+    queue_timeout: Optional[float] = Field(default=None, description="Seconds to wait for an execution slot before giving up with 503", ge=0, le=300)
+    datasets: Optional[List[str]] = Field(default=None, description="Ids of uploaded datasets to expose to the code through the DATASETS dict", max_length=32)
+    profile: bool = Field(default=False, description="Run the code under cProfile and return the hottest functions in 'profile'")
+    profile_top_n: int = Field(default=20, description="Number of functions listed by cumulative and by self time", ge=1, le=100)
+    profile_flamegraph: bool = Field(default=False, description="Also sample the call stack into a collapsed-stack artifact for flame graph tools")
+    cpu_limit: Optional[int] = Field(default=None, description="Most threads BLAS/OpenMP libraries may use; fewer when other executions are running", ge=1, le=256)
+    execution_id: Optional[str] = Field(default=None, description="32 hex digit id to run under, so the execution can be cancelled with DELETE /executions/{id} before it returns; generated if omitted", pattern=EXECUTION_ID_PATTERN)
+
+class Artifact(BaseModel):
+    id: str
+    url: str
+    format: str
+    size_bytes: int
+
+class SecurityViolation(BaseModel):
+    line: int
+    column: int
+    message: str
+
+class StackFrame(BaseModel):
+    filename: str
+    line: Optional[int] = None
+    function: str
+    code: Optional[str] = None
+
+class ErrorDetails(BaseModel):
+    type: str = Field(..., description="Exception class name, e.g. ZeroDivisionError")
+    message: str
+    line: Optional[int] = Field(default=None, description="Line of the submitted code where the error was raised")
+    frames: List[StackFrame] = Field(default_factory=list, description="Traceback frames, outermost first; user code frames have filename <user_code>")
+
+class PlotInfo(BaseModel):
+    name: str
+    figure: int
+    title: Optional[str] = None
+    axes: int
+    width_inches: float
+    height_inches: float
+    dpi: int
+    format: Optional[str] = None
+    size_bytes: Optional[int] = None
+    downscaled: bool = Field(default=False, description="True if the figure was saved at a lower dpi or rasterized to fit plot_max_pixels / plot_max_bytes")
+
+class RichOutput(BaseModel):
+    source: str = Field(..., description="result (trailing expression), show (fig.show()) or display (display())")
+    data: Dict[str, Any] = Field(..., description="MIME type to representation, e.g. text/html, text/plain, application/vnd.plotly.v1+json")
+
+class ProfileEntry(BaseModel):
+    function: str
+    filename: str
+    line: int
+    calls: int
+    self_seconds: float = Field(..., description="Time spent in the function itself")
+    cumulative_seconds: float = Field(..., description="Time spent in the function and everything it called")
+
+class ProfileReport(BaseModel):
+    wall_seconds: float = Field(..., description="Elapsed time of the profiled code")
+    cpu_seconds: float = Field(..., description="CPU time of the execution process over the same span; far below wall_seconds means waiting on I/O or sleep")
+    top_cumulative: List[ProfileEntry]
+    top_self: List[ProfileEntry]
+    flamegraph: Optional[Artifact] = Field(default=None, description="Collapsed stacks (one 'frame;frame;frame count' per line) for flamegraph.pl or speedscope")
 
 class CodeExecutionResponse(BaseModel):
+    execution_id: Optional[str] = Field(default=None, description="Id of the execution that produced this result")
     success: bool
     output: str
     error: Optional[str] = None
     execution_time: float
     memory_used_mb: Optional[float] = None
+    peak_memory_mb: Optional[float] = Field(default=None, description="Peak resident memory of the execution process")
+    unique_memory_mb: Optional[float] = Field(default=None, description="Memory private to the execution process at the end of the run (USS): its marginal cost")
+    shared_memory_mb: Optional[float] = Field(default=None, description="Resident memory shared with other processes, e.g. libraries inherited from a pre-warmed worker")
+    memory_limit_exceeded: bool = Field(default=False, description="True if the execution was stopped by memory_limit_mb")
+    cpu_time_seconds: Optional[float] = Field(default=None, description="User plus system CPU time of the execution and the child processes it waited for")
+    cpu_threads: Optional[int] = Field(default=None, description="Thread budget given to BLAS/OpenMP libraries")
+    cpu_cores: Optional[List[int]] = Field(default=None, description="Cores the execution was pinned to, when CPU_AFFINITY is on")
     timestamp: str
     plots: Optional[List[str]] = Field(default=None, description="Base64 encoded plot images")
+    plot_artifacts: Optional[List[Artifact]] = Field(default=None, description="Plots stored as artifacts, fetch with GET /artifacts/{id}")
+    truncated: bool = Field(default=False, description="True if output or error was cut down to max_output_bytes")
+    output_bytes: Optional[int] = Field(default=None, description="Total bytes written to stdout")
+    error_bytes: Optional[int] = Field(default=None, description="Total bytes written to stderr")
+    output_artifacts: Optional[List[Artifact]] = Field(default=None, description="Full stdout/stderr logs saved when spill_output is set")
+    cache_hit: bool = Field(default=False, description="True if this result was served from the result cache")
+    security_violations: Optional[List[SecurityViolation]] = Field(default=None, description="Restricted operations that caused the code to be rejected")
+    timings: Optional[Dict[str, float]] = Field(default=None, description="Seconds spent in each phase: queue_wait, spawn, user_code, plot_encode, output_parse")
+    error_details: Optional[ErrorDetails] = Field(default=None, description="Structured form of the exception raised by the code")
+    plot_metadata: Optional[List[PlotInfo]] = Field(default=None, description="Figure details, in the same order as plots / plot_artifacts")
+    rich_outputs: Optional[List[RichOutput]] = Field(default=None, description="Values shown with display(), fig.show() or left as the last expression")
+    profile: Optional[ProfileReport] = Field(default=None, description="cProfile report, present when profile was requested")
+
+class BatchExecutionRequest(BaseModel):
+    items: List[CodeExecutionRequest] = Field(..., description="Independent executions to run", min_length=1, max_length=MAX_BATCH_SIZE)
+    parallelism: int = Field(default=MAX_CONCURRENT_EXECUTIONS, description="How many items may run at the same time", ge=1, le=64)
+    deadline: int = Field(default=300, description="Overall deadline for the whole batch in seconds", ge=1, le=3600)
+    stream: bool = Field(default=False, description="Stream results as NDJSON in completion order instead of returning them all at once")
+
+class BatchExecutionResponse(BaseModel):
+    results: List[CodeExecutionResponse]
+    succeeded: int
+    failed: int
+    total_time: float
+
+class JobBatchRequest(BaseModel):
+    items: List[CodeExecutionRequest] = Field(..., description="Executions to queue as separate jobs", min_length=1, max_length=MAX_BATCH_SIZE)
+
+class JobInfo(BaseModel):
+    job_id: str = Field(..., description="Also the execution id of the job's run")
+    status: str = Field(..., description="queued, running, completed, failed or cancelled")
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    result: Optional[CodeExecutionResponse] = Field(default=None, description="The execution response once the job has completed or was cancelled while running")
+    error: Optional[str] = Field(default=None, description="Why the job could not be run at all, e.g. an unknown dataset")
+
+class SessionCreateRequest(BaseModel):
+    memory_limit_mb: int = Field(default=SESSION_MEMORY_LIMIT_MB, description="Memory the session may use on top of its baseline, in MB", ge=64, le=4096)
+
+class SessionInfo(BaseModel):
+    session_id: str
+    created_at: str
+    last_used_at: str
+    memory_limit_mb: int
+    executions: int
+    idle_timeout: int
+
+class DatasetInfo(BaseModel):
+    id: str = Field(..., description="SHA-256 of the file's content")
+    name: str
+    size_bytes: int
+    created_at: str
+    parquet: bool = Field(default=False, description="True once a Parquet copy of a CSV upload is available")
 
 class LibraryInfo(BaseModel):
     name: str
     version: str
     description: Optional[str] = None
+    modules: List[str] = Field(default_factory=list, description="Top-level modules the package provides, i.e. what to import")
 
 # Security: Restricted imports and operations
+# Also rejected as bare names outside function locals: the wrapper script imports os, sys and psutil
 RESTRICTED_IMPORTS = {
     'os', 'subprocess', 'sys', 'importlib', 'builtins', '__builtin__',
-    'eval', 'exec', 'compile', 'open', 'file', 'input', 'raw_input',
-    'reload', '__import__', 'globals', 'locals', 'vars', 'dir',
-    'delattr', 'setattr', 'getattr', 'hasattr'
+    'ctypes', 'posix', 'pty', '_posixsubprocess', 'psutil'
 }
 
 RESTRICTED_FUNCTIONS = {
     'eval', 'exec', 'compile', 'open', 'file', 'input', 'raw_input',
-    '__import__', 'reload', 'globals', 'locals', 'vars', 'dir'
+    '__import__', 'reload', 'globals', 'locals', 'vars', 'dir', 'breakpoint'
 }
 
+# Only allowed with a literal, non-dunder attribute name
+REFLECTION_FUNCTIONS = {'getattr', 'setattr', 'delattr'}
+
+# Attributes that reach the OS or interpreter internals (frames hold globals and builtins)
+RESTRICTED_ATTRIBUTES = {
+    'system', 'popen', 'modules',
+    'f_globals', 'f_locals', 'f_builtins', 'f_back', 'tb_frame', 'gi_frame', 'cr_frame', 'ag_frame'
+}
+
+# Dunders that cannot be used to escape the sandbox; all others are rejected
+ALLOWED_DUNDERS = {
+    '__name__', '__doc__', '__version__', '__init__', '__len__', '__str__', '__repr__',
+    '__eq__', '__hash__', '__iter__', '__next__', '__enter__', '__exit__',
+    '__getitem__', '__setitem__', '__contains__', '__call__', '__all__'
+}
+
+SECURITY_CACHE_SIZE = 1024
+
+def is_dunder(name: str) -> bool:
+    return name.startswith('__') and name.endswith('__') and name not in ALLOWED_DUNDERS
+
+FUNCTION_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)
+COMPREHENSION_SCOPES = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+def local_bindings(node: ast.AST) -> tuple[set, set]:
+    """Names a function, lambda or comprehension binds as its own locals, and the names it declares global or nonlocal.
+    
+    Nested scopes are not entered, except to record the name of a nested def or class. Walrus
+    targets inside a comprehension bind in the enclosing scope, so they are not counted for it.
+    """
+    bound, declared = set(), set()
+    if isinstance(node, FUNCTION_SCOPES):
+        arguments = node.args
+        bound.update(arg.arg for arg in arguments.posonlyargs + arguments.args + arguments.kwonlyargs + [arguments.vararg, arguments.kwarg] if arg)
+        pending = list(node.body) if isinstance(node.body, list) else [node.body]
+    else:
+        pending = [child for child in (getattr(node, 'elt', None), getattr(node, 'key', None), getattr(node, 'value', None)) if child]
+        for index, generator in enumerate(node.generators):
+            pending += [generator.target] + generator.ifs + ([generator.iter] if index else [])
+    while pending:
+        child = pending.pop()
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(child.name)
+            continue
+        if isinstance(child, (ast.Lambda,) + COMPREHENSION_SCOPES):
+            continue
+        if isinstance(child, ast.NamedExpr) and isinstance(node, COMPREHENSION_SCOPES):
+            pending.append(child.value)
+            continue
+        if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+            bound.add(child.id)
+        elif isinstance(child, (ast.Import, ast.ImportFrom)):
+            bound.update((alias.asname or alias.name).split('.')[0] for alias in child.names)
+        elif isinstance(child, ast.ExceptHandler) and child.name:
+            bound.add(child.name)
+        elif isinstance(child, (ast.Global, ast.Nonlocal)):
+            declared.update(child.names)
+        pending.extend(ast.iter_child_nodes(child))
+    return bound, declared
+
+class SecurityChecker(ast.NodeVisitor):
+    """Walks a module's AST once and records every restricted import, call and attribute access."""
+    
+    def __init__(self):
+        self.found: List[SecurityViolation] = []
+        # Enclosing function/lambda/comprehension scopes as (bound names, global/nonlocal names);
+        # a restricted builtin name is only allowed where it resolves to one of their locals
+        self.scopes: List[tuple[set, set]] = []
+    
+    def violation(self, node: ast.AST, message: str) -> SecurityViolation:
+        return SecurityViolation(line=node.lineno, column=node.col_offset + 1, message=message)
+    
+    def report(self, node: ast.AST, message: str) -> None:
+        self.found.append(self.violation(node, message))
+    
+    @property
+    def violations(self) -> List[SecurityViolation]:
+        return sorted(self.found, key=lambda violation: (violation.line, violation.column))
+    
+    def is_local(self, name: str) -> bool:
+        """True if name resolves to a local of an enclosing function scope, so never to the builtin.
+        
+        Module and class level bindings do not count: they may be skipped, run after the use,
+        or be the builtin itself (open = open).
+        """
+        for bound, declared in reversed(self.scopes):
+            if name in declared:
+                return False
+            if name in bound:
+                return True
+        return False
+    
+    def visit_in_scope(self, scope: ast.AST, children: List[ast.AST]) -> None:
+        self.scopes.append(local_bindings(scope))
+        for child in children:
+            self.visit(child)
+        self.scopes.pop()
+    
+    def visit_Import(self, node: ast.Import) -> None:
+        for alias in node.names:
+            root = alias.name.split('.')[0]
+            if root in RESTRICTED_IMPORTS:
+                self.report(node, f"Restricted import '{root}'")
+    
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:
+        root = (node.module or '').split('.')[0]
+        if node.level == 0 and root in RESTRICTED_IMPORTS:
+            self.report(node, f"Restricted import '{root}'")
+        for alias in node.names:
+            if alias.name in RESTRICTED_IMPORTS or alias.name in RESTRICTED_FUNCTIONS or is_dunder(alias.name):
+                self.report(node, f"Restricted import '{alias.name}'")
+    
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> None:
+        # Decorators, defaults and annotations are evaluated in the enclosing scope
+        arguments = node.args
+        for child in node.decorator_list + arguments.defaults + [default for default in arguments.kw_defaults if default]:
+            self.visit(child)
+        for arg in arguments.posonlyargs + arguments.args + arguments.kwonlyargs + [arguments.vararg, arguments.kwarg]:
+            if arg and arg.annotation:
+                self.visit(arg.annotation)
+        if node.returns:
+            self.visit(node.returns)
+        self.visit_in_scope(node, node.body)
+    
+    visit_AsyncFunctionDef = visit_FunctionDef
+    
+    def visit_Lambda(self, node: ast.Lambda) -> None:
+        for child in node.args.defaults + [default for default in node.args.kw_defaults if default]:
+            self.visit(child)
+        self.visit_in_scope(node, [node.body])
+    
+    def visit_comprehension_scope(self, node: ast.AST) -> None:
+        # The first iterable is evaluated in the enclosing scope
+        first, *rest = node.generators
+        self.visit(first.iter)
+        children = [first.target] + first.ifs
+        for generator in rest:
+            children += [generator.target, generator.iter] + generator.ifs
+        children += [child for child in (getattr(node, 'key', None), getattr(node, 'value', None), getattr(node, 'elt', None)) if child]
+        self.visit_in_scope(node, children)
+    
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_comprehension_scope
+    
+    def visit_Name(self, node: ast.Name) -> None:
+        if not isinstance(node.ctx, ast.Load):
+            return
+        if node.id in RESTRICTED_FUNCTIONS:
+            if not self.is_local(node.id):
+                self.report(node, f"Restricted function '{node.id}'")
+        elif node.id in RESTRICTED_IMPORTS:
+            # The module cannot be imported, so a global of that name can only be one provided to the code
+            if not self.is_local(node.id):
+                self.report(node, f"Restricted module access '{node.id}'")
+        elif is_dunder(node.id):
+            self.report(node, f"Restricted name '{node.id}'")
+    
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        if is_dunder(node.attr):
+            self.report(node, f"Restricted attribute '{node.attr}'")
+        elif node.attr in RESTRICTED_IMPORTS:
+            self.report(node, f"Restricted module access '.{node.attr}'")
+        elif node.attr in RESTRICTED_ATTRIBUTES:
+            self.report(node, f"Potentially dangerous operation '.{node.attr}'")
+        self.generic_visit(node)
+    
+    def visit_Call(self, node: ast.Call) -> None:
+        if isinstance(node.func, ast.Name) and node.func.id in REFLECTION_FUNCTIONS and not self.is_local(node.func.id):
+            name = node.args[1] if len(node.args) > 1 else None
+            if not (isinstance(name, ast.Constant) and isinstance(name.value, str)):
+                self.report(node, f"'{node.func.id}' is only allowed with a literal attribute name")
+            elif is_dunder(name.value) or name.value in RESTRICTED_IMPORTS or name.value in RESTRICTED_ATTRIBUTES:
+                self.report(node, f"Restricted attribute '{name.value}'")
+        self.generic_visit(node)
+
+# Verdicts by SHA-256 of the code, most recently used last. Checks run in worker threads
+# (asyncio.to_thread), so every access goes through the lock; parsing happens outside it
+security_cache: OrderedDict[str, List[SecurityViolation]] = OrderedDict()
+security_cache_lock = threading.Lock()
+
+def find_security_violations(code: str) -> List[SecurityViolation]:
+    """Return every restricted operation in code, with line/column positions.
+    
+    Code that does not parse is let through so the interpreter can report the SyntaxError.
+    """
+    digest = hashlib.sha256(code.encode('utf-8', errors='surrogatepass')).hexdigest()
+    with security_cache_lock:
+        if digest in security_cache:
+            security_cache.move_to_end(digest)
+            return security_cache[digest]
+    
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        violations = []
+    else:
+        checker = SecurityChecker()
+        checker.visit(tree)
+        violations = checker.violations
+    
+    with security_cache_lock:
+        security_cache[digest] = violations
+        if len(security_cache) > SECURITY_CACHE_SIZE:
+            security_cache.popitem(last=False)
+    return violations
+
 def check_code_security(code: str) -> tuple[bool, str]:
     """Check if code contains restricted operations."""
-    lines = code.split('\n')
+    violations = find_security_violations(code)
+    if violations:
+        first = violations[0]
+        return False, f"{first.message} found at line {first.line}, column {first.column}"
+    return True, ""
+
+async def read_lines(stream: asyncio.StreamReader, on_lines: Callable[[List[str]], Awaitable[None]]) -> None:
+    """Read a subprocess pipe until EOF, passing complete lines (with their newline) to on_lines.
     
-    for line_num, line in enumerate(lines, 1):
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue
-            
-        # Check for restricted imports
-        if line.startswith('import ') or line.startswith('from '):
-            for restricted in RESTRICTED_IMPORTS:
-                if restricted in line:
-                    return False, f"Restricted import '{restricted}' found at line {line_num}"
+    Lines longer than STREAM_CHUNK_SIZE are passed on in pieces so a single huge line
+    is never held in memory in full.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = await stream.read(STREAM_CHUNK_SIZE)
+        lines = (pending + decoder.decode(chunk, final=not chunk)).split('\n')
+        pending = lines.pop()
+        lines = [line + '\n' for line in lines]
+        if pending and (not chunk or len(pending) > STREAM_CHUNK_SIZE):
+            lines.append(pending)
+            pending = ''
+        if lines:
+            await on_lines(lines)
+        if not chunk:
+            break
+
+async def read_messages(stream: asyncio.StreamReader, on_message: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+    """Read length-prefixed JSON messages from the wrapper's side channel until EOF."""
+    while True:
+        try:
+            header = await stream.readexactly(4)
+        except asyncio.IncompleteReadError:
+            return
+        (length,) = struct.unpack(">I", header)
+        if length > CHANNEL_MAX_MESSAGE_BYTES:
+            # Not something the wrapper sends; stop listening rather than buffer it
+            return
+        try:
+            message = json.loads(await stream.readexactly(length))
+        except (asyncio.IncompleteReadError, ValueError):
+            return
+        if isinstance(message, dict):
+            await on_message(message)
+
+async def sample_memory(pid: int, on_event: Callable[[str, Dict[str, Any]], Awaitable[None]]) -> None:
+    """Periodically report the resident memory of an execution and its child processes."""
+    try:
+        process = psutil.Process(pid)
+        while True:
+            await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+            rss = process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+            await on_event("memory", {"rss_mb": round(rss / 1024 / 1024, 2)})
+    except psutil.Error:
+        pass
+
+def signal_process_group(pgid: int, signum: int) -> None:
+    try:
+        os.killpg(pgid, signum)
+    except ProcessLookupError:
+        pass
+
+async def kill_process_group(process: asyncio.subprocess.Process, grace_seconds: float = KILL_GRACE_SECONDS) -> None:
+    """Stop the process and everything it spawned in its session.
+    
+    The whole group gets SIGTERM first, so that e.g. multiprocessing pools can shut down, and
+    SIGKILL once the process has exited or grace_seconds have passed. Descendants that started
+    their own session are out of reach of the group signals; they are looked up with psutil
+    beforehand and killed afterwards.
+    """
+    if os.name == 'nt':
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        return
+    
+    try:
+        descendants = psutil.Process(process.pid).children(recursive=True)
+    except psutil.Error:
+        descendants = []
+    signal_process_group(process.pid, signal.SIGTERM)
+    exited = asyncio.ensure_future(process.wait())
+    try:
+        await asyncio.wait_for(asyncio.shield(exited), grace_seconds)
+    except asyncio.TimeoutError:
+        pass
+    signal_process_group(process.pid, signal.SIGKILL)
+    for descendant in descendants:
+        try:
+            if descendant.is_running() and os.getpgid(descendant.pid) != process.pid:
+                descendant.kill()
+                ORPHANS_KILLED_TOTAL.inc()
+        except (psutil.Error, ProcessLookupError):
+            pass
+    await exited
+
+# Source of the pre-warmed worker ("zygote"). It imports the warm modules once, then for every
+# job received on the control socket forks a fresh child that runs the wrapper script with the
+# stdin/stdout/stderr pipes passed in by the API process.
+# In "session" mode it runs every job itself, in one namespace that persists between jobs.
+ZYGOTE_SOURCE = """
+import gc, importlib, json, os, resource, socket, sys, traceback
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+for name in json.loads(sys.argv[1]):
+    try:
+        importlib.import_module(name)
+    except Exception as e:
+        print(f"warm import of {name} failed: {e}", file=sys.stderr)
+
+# Keep the warm objects out of the collector so that collections in forked children
+# do not write to (and so copy) the pages they share with this process
+gc.collect()
+gc.freeze()
+
+control = socket.socket(fileno=int(sys.argv[2]))
+mode = sys.argv[3]
+CHANNEL_FD_ENV = sys.argv[5]
+report = os.fdopen(os.dup(1), 'w')
+namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+
+if mode == 'session' and int(sys.argv[4]):
+    # Cap what the session may allocate on top of the warm baseline
+    import psutil
+    limit = psutil.Process().memory_info().vms + int(sys.argv[4]) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def send(message):
+    report.write(json.dumps(message) + "\\n")
+    report.flush()
+
+def redirect(fds):
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+
+def run_source(globals_):
+    chunks = []
+    while True:
+        chunk = os.read(0, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    try:
+        source = b''.join(chunks).decode('utf-8')
+        exec(compile(source, '<sandbox>', 'exec'), globals_)
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+
+def run_child(fds):
+    exit_code = 1
+    try:
+        os.setsid()
+        control.close()
+        report.close()
+        redirect(fds[:3])
+        os.environ[CHANNEL_FD_ENV] = str(fds[3])
+        exit_code = run_source({'__name__': '__main__', '__builtins__': __builtins__})
+    finally:
+        os._exit(exit_code)
+
+def run_in_session(fds):
+    saved = [os.dup(target) for target in range(3)]
+    redirect(fds[:3])
+    os.environ[CHANNEL_FD_ENV] = str(fds[3])
+    try:
+        return run_source(namespace)
+    finally:
+        redirect(saved)
+        # Closing the channel tells the API process this execution is done
+        os.close(fds[3])
+        os.environ.pop(CHANNEL_FD_ENV, None)
+
+send({"ready": True})
+while True:
+    try:
+        message, fds, _, _ = socket.recv_fds(control, 1024, 4)
+    except OSError:
+        break
+    if not message:
+        break
+    if mode == 'session':
+        send({"pid": os.getpid()})
+        exit_code = run_in_session(fds)
+        send({"pid": os.getpid(), "returncode": exit_code, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+        continue
+    pid = os.fork()
+    if pid == 0:
+        run_child(fds)
+    for fd in fds:
+        os.close(fd)
+    send({"pid": pid})
+    _, status, rusage = os.wait4(pid, 0)
+    send({"pid": pid, "returncode": os.waitstatus_to_exitcode(status), "max_rss_kb": rusage.ru_maxrss})
+"""
+
+class ForkedChild:
+    """Process-like handle for a child forked by a pre-warmed worker."""
+    
+    def __init__(self, worker: 'PrewarmedWorker', pid: int, stdout: asyncio.StreamReader,
+                 stderr: asyncio.StreamReader, channel: asyncio.StreamReader):
+        self.worker = worker
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.channel = channel
+        self.returncode: Optional[int] = None
+        self.peak_memory_mb: Optional[float] = None
+    
+    async def wait(self) -> int:
+        if self.returncode is None:
+            try:
+                message = await self.worker.read_message()
+            except ConnectionError:
+                # The worker itself died (e.g. a session killed on timeout)
+                self.returncode = -signal.SIGKILL
+                return self.returncode
+            self.returncode = message.get("returncode", -1)
+            if message.get("max_rss_kb"):
+                # Reported by os.wait4, so it covers the whole life of the child
+                self.peak_memory_mb = message["max_rss_kb"] / 1024
+        return self.returncode
+
+async def open_read_pipe(fd: int) -> asyncio.StreamReader:
+    """Wrap the read end of an os.pipe() in an asyncio StreamReader."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=STREAM_CHUNK_SIZE)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+    return reader
+
+async def write_and_close_pipe(fd: int, data: bytes) -> None:
+    """Write data to the write end of an os.pipe() without blocking, closing it once flushed."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(fd, 'wb', 0))
+    transport.write(data)
+    transport.close()
+
+class PrewarmedWorker:
+    """A long-lived interpreter with the warm modules imported that forks one child per execution.
+    
+    Session workers (mode="session") instead run every execution themselves in a persistent
+    namespace, capped at memory_limit_mb above their warm baseline.
+    """
+    
+    def __init__(self, process: asyncio.subprocess.Process, control: socket.socket, mode: str = "fork"):
+        self.process = process
+        self.control = control
+        self.mode = mode
+        self.uses = 0
+        self.alive = True
+    
+    @classmethod
+    async def start(cls, modules: List[str], mode: str = "fork", memory_limit_mb: int = 0) -> 'PrewarmedWorker':
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", ZYGOTE_SOURCE, json.dumps(modules), str(child_sock.fileno()),
+                mode, str(memory_limit_mb), CHANNEL_FD_ENV,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                pass_fds=(child_sock.fileno(),),
+                # Sessions run user code in the worker itself, so it must be killable as a group
+                start_new_session=mode == "session"
+            )
+        finally:
+            child_sock.close()
+        worker = cls(process, parent_sock, mode)
+        await worker.read_message()  # wait until the warm imports are done
+        return worker
+    
+    async def read_message(self) -> Dict[str, Any]:
+        line = await self.process.stdout.readline()
+        if not line:
+            self.alive = False
+            raise ConnectionError("pre-warmed worker exited")
+        return json.loads(line)
+    
+    async def spawn(self, source: str) -> ForkedChild:
+        self.uses += 1
+        pipes = [os.pipe() for _ in range(4)]
+        child_fds = [pipes[0][0], pipes[1][1], pipes[2][1], pipes[3][1]]
+        try:
+            socket.send_fds(self.control, [b"run"], child_fds)
+        except OSError:
+            self.alive = False
+            for read_fd, write_fd in pipes:
+                os.close(read_fd)
+                os.close(write_fd)
+            raise
+        finally:
+            if self.alive:
+                for fd in child_fds:
+                    os.close(fd)
         
-        # Check for restricted functions
-        for restricted in RESTRICTED_FUNCTIONS:
-            if restricted in line and f'{restricted}(' in line:
-                return False, f"Restricted function '{restricted}' found at line {line_num}"
+        await write_and_close_pipe(pipes[0][1], source.encode('utf-8'))
+        stdout = await open_read_pipe(pipes[1][0])
+        stderr = await open_read_pipe(pipes[2][0])
+        channel = await open_read_pipe(pipes[3][0])
+        message = await self.read_message()
+        return ForkedChild(self, message["pid"], stdout, stderr, channel)
+    
+    async def stop(self) -> None:
+        self.alive = False
+        self.control.close()
+        if self.mode == "session":
+            # Also takes down anything the session's code started
+            await kill_process_group(self.process)
+            return
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+        await self.process.wait()
+
+class WorkerPool:
+    """Keeps a set of pre-warmed workers ready and replaces them in the background."""
+    
+    def __init__(self, size: int, max_uses: int, modules: List[str]):
+        self.size = size
+        self.max_uses = max_uses
+        self.modules = modules
+        self.idle: List[PrewarmedWorker] = []
+        self.busy = 0
+        self.starting = 0
+        self.closed = False
+    
+    def start(self) -> None:
+        for _ in range(self.size):
+            self.refill()
+    
+    def refill(self) -> None:
+        """Start a replacement worker without blocking the caller."""
+        if self.closed or len(self.idle) + self.busy + self.starting >= self.size:
+            return
+        self.starting += 1
+        asyncio.create_task(self._start_worker())
+    
+    async def _start_worker(self) -> None:
+        try:
+            worker = await PrewarmedWorker.start(self.modules)
+        except Exception as e:
+            logger.error(f"Failed to start pre-warmed worker: {str(e)}")
+            return
+        finally:
+            self.starting -= 1
+        if self.closed:
+            await worker.stop()
+        else:
+            self.idle.append(worker)
+    
+    def acquire(self) -> Optional[PrewarmedWorker]:
+        """Take an idle worker, or None if all are busy or still warming up."""
+        while self.idle:
+            worker = self.idle.pop()
+            if worker.alive:
+                self.busy += 1
+                return worker
+        return None
+    
+    def release(self, worker: PrewarmedWorker) -> None:
+        self.busy -= 1
+        if worker.alive and worker.uses < self.max_uses and not self.closed:
+            self.idle.append(worker)
+        else:
+            asyncio.create_task(worker.stop())
+            self.refill()
+    
+    def warm_memory_mb(self) -> Optional[float]:
+        """Resident memory of one idle worker: what each forked child starts out sharing."""
+        for worker in self.idle:
+            try:
+                return psutil.Process(worker.process.pid).memory_info().rss / 1024 / 1024
+            except psutil.Error:
+                continue
+        return None
+    
+    async def shutdown(self) -> None:
+        self.closed = True
+        workers, self.idle = self.idle, []
+        await asyncio.gather(*(worker.stop() for worker in workers), return_exceptions=True)
+
+worker_pool: Optional[WorkerPool] = WorkerPool(WORKER_POOL_SIZE, WORKER_MAX_USES, WORKER_WARM_MODULES) if WORKER_POOL_SIZE > 0 else None
+
+class OutputBuffer:
+    """Keeps the head and tail of a stream within max_bytes.
+    
+    With a spill_path, the complete stream is written to that file once it outgrows max_bytes,
+    so nothing is lost while memory use stays flat.
+    """
+    
+    def __init__(self, max_bytes: int, spill_path: Optional[str] = None):
+        self.head_limit = max_bytes // 2
+        self.tail_limit = max_bytes - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+        self.spill_path = spill_path
+        self.spill_file = None
+    
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > len(self.head) + len(self.tail)
+    
+    def write(self, text: str) -> None:
+        data = text.encode('utf-8')
+        self.total_bytes += len(data)
+        if self.spill_path and self.spill_file is None and self.total_bytes > self.head_limit + self.tail_limit:
+            self.spill_file = open(self.spill_path, 'wb')
+            self.spill_file.write(self.head + self.tail)
+        if self.spill_file:
+            self.spill_file.write(data)
         
-        # Check for dangerous operations
-        dangerous_patterns = ['__', 'subprocess', 'os.system', 'os.popen', 'eval(', 'exec(']
-        for pattern in dangerous_patterns:
-            if pattern in line:
-                return False, f"Potentially dangerous operation '{pattern}' found at line {line_num}"
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        self.tail += data
+        if len(self.tail) > self.tail_limit:
+            del self.tail[:len(self.tail) - self.tail_limit]
     
-    return True, ""
+    def getvalue(self) -> str:
+        if not self.truncated:
+            return bytes(self.head + self.tail).decode('utf-8', errors='replace')
+        omitted = self.total_bytes - len(self.head) - len(self.tail)
+        return (
+            bytes(self.head).decode('utf-8', errors='ignore')
+            + f"\n... [{omitted} bytes truncated] ...\n"
+            + bytes(self.tail).decode('utf-8', errors='ignore')
+        )
+    
+    def close(self) -> bool:
+        """Close the spill file, returning True if one was written."""
+        if self.spill_file is None:
+            return False
+        self.spill_file.close()
+        return True
+
+def artifact_reference(directory_id: str, name: str, path: str) -> Dict[str, Any]:
+    artifact_id = f"{directory_id}/{name}"
+    return {
+        "id": artifact_id,
+        "url": f"/artifacts/{artifact_id}",
+        "format": name.rsplit('.', 1)[-1],
+        "size_bytes": os.path.getsize(path)
+    }
 
-async def execute_code_safely(code: str, timeout: int = 30, memory_limit_mb: int = 512) -> Dict[str, Any]:
-    """Execute Python code safely with restrictions."""
+def collect_plots(artifact_dir: str, directory_id: str, plot_files: List[str], inline: bool) -> tuple[Optional[List[str]], Optional[List[Dict[str, Any]]]]:
+    """Turn the figure files written by an execution into inline base64 plots or artifact references."""
+    plots = []
+    artifacts = []
+    for name in plot_files:
+        path = os.path.join(artifact_dir, name)
+        if not os.path.isfile(path):
+            continue
+        if inline:
+            with open(path, 'rb') as plot_file:
+                plots.append(base64.b64encode(plot_file.read()).decode())
+        else:
+            artifacts.append(artifact_reference(directory_id, name, path))
+    return plots or None, artifacts or None
+
+def sweep_artifacts() -> None:
+    """Delete artifact directories older than ARTIFACT_TTL_SECONDS."""
+    if not os.path.isdir(ARTIFACTS_DIR):
+        return
+    cutoff = time.time() - ARTIFACT_TTL_SECONDS
+    for entry in os.scandir(ARTIFACTS_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+async def execute_code_safely(code: str, timeout: int = 30, memory_limit_mb: int = 512,
+                              plot_format: str = "png", plot_dpi: int = 150, max_plots: int = 20,
+                              plot_max_pixels: Optional[int] = None, plot_max_bytes: Optional[int] = None,
+                              rich_output: bool = True, max_rich_outputs: int = 20,
+                              inline_plots: bool = True, max_output_bytes: int = MAX_OUTPUT_BYTES,
+                              spill_output: bool = False,
+                              on_event: Optional[Callable[[str, Dict[str, Any]], Awaitable[None]]] = None,
+                              capture_output: bool = True, worker: Optional['PrewarmedWorker'] = None,
+                              apply_memory_limit: bool = True,
+                              datasets: Optional[Dict[str, str]] = None, profile: bool = False,
+                              profile_top_n: int = 20, profile_flamegraph: bool = False,
+                              cpu_threads: Optional[int] = None,
+                              cpu_cores: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Execute Python code safely with restrictions.
+    
+    If on_event is given it is awaited with ("stdout" | "stderr" | "plot" | "display" | "memory" | "truncated", payload)
+    while the script runs; awaiting it applies backpressure to the script's output pipes.
+    With capture_output=False stdout is only forwarded to on_event and not kept for the result.
+    Each stream keeps at most max_output_bytes in memory (see OutputBuffer).
+    A given worker (a session) is used instead of the shared pool; with apply_memory_limit=False
+    the wrapper leaves memory limits to that worker.
+    datasets maps file names to read-only paths and is visible to the code as DATASETS.
+    """
     
-    # Security check
-    is_safe, error_msg = check_code_security(code)
-    if not is_safe:
+    # Security check (parsing large submissions would otherwise hold up the event loop)
+    violations = await asyncio.to_thread(find_security_violations, code)
+    if violations:
+        SECURITY_REJECTIONS_TOTAL.inc()
+        first = violations[0]
         return {
             "success": False,
             "output": "",
-            "error": f"Security violation: {error_msg}",
+            "error": f"Security violation: {first.message} found at line {first.line}, column {first.column}",
             "execution_time": 0.0,
             "memory_used_mb": None,
-            "plots": None
+            "peak_memory_mb": None,
+            "memory_limit_exceeded": False,
+            "plots": None,
+            "plot_artifacts": None,
+            "security_violations": violations
         }
     
-    # Create temporary file for code execution
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as temp_file:
-        # Add memory monitoring and safe imports
-        # Properly indent user code
-        indented_code = '\n'.join('    ' + line for line in code.split('\n'))
-        
-        safe_code = f'''import sys
+    # Figures are written straight to a per-execution artifact directory instead of stdout.
+    # It is named by the server, not after the client-chosen execution_id, so reusing an
+    # execution_id cannot overwrite or delete an earlier run's artifacts
+    directory_id = uuid.uuid4().hex
+    artifact_dir = os.path.join(ARTIFACTS_DIR, directory_id)
+    os.makedirs(artifact_dir, exist_ok=True)
+    
+    # Add memory monitoring and safe imports; the user code is embedded as a string literal
+    safe_code = f'''import sys
 import traceback
+import linecache as _sandbox_linecache
+import ast as _sandbox_ast
 import psutil
 import os
 import gc
 from datetime import datetime
-import base64
-import io
+import time as _sandbox_time
+import json as _sandbox_json
+import struct as _sandbox_struct
 
-# Monitor memory usage
-process = psutil.Process(os.getpid())
-initial_memory = process.memory_info().rss / 1024 / 1024
+# Per-phase timings reported back to the API process
+_sandbox_timings = {{"started_at": _sandbox_time.time()}}
+
+# Structured results go to the API process over the side channel, never through stdout
+_sandbox_channel = open(int(os.environ.pop({CHANNEL_FD_ENV!r})), "wb", closefd=False)
 
-# Plot handling
-plot_data = []
+def _sandbox_send(message):
+    data = _sandbox_json.dumps(message).encode("utf-8")
+    _sandbox_channel.write(_sandbox_struct.pack(">I", len(data)) + data)
+    _sandbox_channel.flush()
+
+# Monitor memory usage
+_sandbox_process = psutil.Process(os.getpid())
+_sandbox_initial_memory = _sandbox_process.memory_info().rss / 1024 / 1024
+_sandbox_memory_used = None
 
 try:
-    # User code starts here
-{indented_code}
+    import resource as _sandbox_resource
+except ImportError:
+    _sandbox_resource = None
+
+def _sandbox_cpu_time():
+    """CPU time of this process and of the children it has waited for."""
+    usage = [_sandbox_resource.getrusage(who) for who in (_sandbox_resource.RUSAGE_SELF, _sandbox_resource.RUSAGE_CHILDREN)]
+    return sum(entry.ru_utime + entry.ru_stime for entry in usage)
+
+# Measured from here so that interpreter startup and earlier session runs are not counted
+_sandbox_cpu_start = _sandbox_cpu_time() if _sandbox_resource else None
+
+# Enforce the memory limit on top of the interpreter baseline
+if _sandbox_resource and {apply_memory_limit}:
+    try:
+        _sandbox_address_space_limit = _sandbox_process.memory_info().vms + {memory_limit_mb} * 1024 * 1024
+        _sandbox_resource.setrlimit(_sandbox_resource.RLIMIT_AS, (_sandbox_address_space_limit, _sandbox_address_space_limit))
+    except (ValueError, OSError):
+        pass
+
+# CPU budget: thread pools that start later (and joblib/multiprocessing children) read the
+# environment; BLAS libraries already loaded by a pre-warmed worker are resized with threadpoolctl
+if {cpu_threads!r}:
+    for _sandbox_variable in {THREAD_COUNT_VARIABLES!r}:
+        os.environ[_sandbox_variable] = str({cpu_threads!r})
+    if "numpy" in sys.modules:
+        try:
+            from threadpoolctl import threadpool_limits as _sandbox_threadpool_limits
+            _sandbox_threadpool_limits({cpu_threads!r})
+        except Exception:
+            pass
+if {cpu_cores!r}:
+    try:
+        os.sched_setaffinity(0, {cpu_cores!r})
+    except (AttributeError, OSError):
+        pass
+
+# Plot handling: figures are encoded when plt.show() is called and at the end of the run
+_sandbox_artifact_dir = {artifact_dir!r}
+_sandbox_plot_files = []
+_sandbox_plots_skipped = 0
+_sandbox_timings["plot_encode"] = 0.0
+
+def _sandbox_save_figure(fig, fig_num):
+    """Save one figure within the pixel and byte budgets, downscaling or rasterizing if needed."""
+    plot_format = {plot_format!r}
+    dpi = {plot_dpi}
+    width, height = fig.get_size_inches()
+    downscaled = False
+    if {plot_max_pixels or 0} and plot_format != "svg" and width * height * dpi * dpi > {plot_max_pixels or 0}:
+        dpi = max(10, int(({plot_max_pixels or 0} / (width * height)) ** 0.5))
+        downscaled = True
+    if plot_format == "svg" and {plot_max_bytes or 0}:
+        # Dense data would make a huge SVG: embed it as an image and keep axes and text as vectors
+        artists = [artist for ax in fig.axes for artist in list(ax.collections) + list(ax.lines)]
+        points = sum(len(artist.get_offsets()) if hasattr(artist, "get_offsets") else len(artist.get_xdata()) for artist in artists)
+        if points > 10_000:
+            for artist in artists:
+                artist.set_rasterized(True)
+            downscaled = True
+    for attempt in range(4):
+        name = f"plot_{{len(_sandbox_plot_files)}}.{{plot_format}}"
+        path = os.path.join(_sandbox_artifact_dir, name)
+        fig.savefig(path, format=plot_format, bbox_inches='tight', dpi=dpi)
+        size = os.path.getsize(path)
+        if not {plot_max_bytes or 0} or size <= {plot_max_bytes or 0} or attempt == 3:
+            break
+        os.unlink(path)
+        downscaled = True
+        if plot_format == "svg":
+            # Too many vector elements for the budget: rasterize instead
+            plot_format = "png"
+        else:
+            dpi = max(10, int(dpi * ({plot_max_bytes or 0} / size) ** 0.5 * 0.9))
+    _sandbox_plot_files.append(name)
+    titles = [ax.get_title() for ax in fig.axes if ax.get_title()]
+    suptitle = getattr(fig, "_suptitle", None)
+    _sandbox_send({{
+        "type": "plot",
+        "name": name,
+        "figure": fig_num,
+        "title": suptitle.get_text() if suptitle else (titles[0] if titles else None),
+        "axes": len(fig.axes),
+        "width_inches": float(width),
+        "height_inches": float(height),
+        "dpi": dpi,
+        "format": plot_format,
+        "size_bytes": size,
+        "downscaled": downscaled
+    }})
+
+def _sandbox_save_open_figures():
+    """Encode and close every open figure, up to max_plots per execution."""
+    global _sandbox_plots_skipped
+    started = _sandbox_time.perf_counter()
+    pyplot = sys.modules["matplotlib.pyplot"]
+    try:
+        for fig_num in pyplot.get_fignums():
+            if len(_sandbox_plot_files) < {max_plots}:
+                _sandbox_save_figure(pyplot.figure(fig_num), fig_num)
+            else:
+                _sandbox_plots_skipped += 1
+        pyplot.close('all')  # Close all figures to free memory
+    finally:
+        _sandbox_timings["plot_encode"] += _sandbox_time.perf_counter() - started
+
+def _sandbox_show(*args, **kwargs):
+    # A figure that cannot be encoded must not fail the user code at its plt.show() call
+    try:
+        _sandbox_save_open_figures()
+    except Exception as error:
+        print(f"[plot capture failed: {{str(error)}}]", file=sys.stderr)
+        # Drop the figures so the end of the run does not try them again
+        sys.modules["matplotlib.pyplot"].close('all')
+
+def _sandbox_patch_pyplot(pyplot):
+    pyplot.show = _sandbox_show
+
+# Rich output: values shown with fig.show() / display() or left as the last expression
+_sandbox_rich_outputs = 0
+
+def _sandbox_mimebundle(value):
+    """Describe a value the way Jupyter would, preferring compact, client-renderable forms."""
+    module = type(value).__module__ or ""
+    if module.startswith("matplotlib") or (isinstance(value, list) and value and type(value[0]).__module__.startswith("matplotlib")):
+        return None  # figures are captured as plots
+    if module.startswith("plotly") and hasattr(value, "to_plotly_json"):
+        import plotly.io as _sandbox_plotly_io
+        return {{"application/vnd.plotly.v1+json": _sandbox_json.loads(_sandbox_plotly_io.to_json(value, validate=False))}}
+    bundle = {{}}
+    if module.startswith("pandas") and hasattr(value, "to_html"):
+        bundle["text/html"] = value.to_html(max_rows={RICH_OUTPUT_MAX_ROWS}, max_cols=20)
+    elif module.startswith("pandas") and hasattr(value, "to_frame"):
+        bundle["text/html"] = value.to_frame().to_html(max_rows={RICH_OUTPUT_MAX_ROWS})
+    elif hasattr(value, "_repr_mimebundle_"):
+        data = value._repr_mimebundle_()
+        bundle.update(data[0] if isinstance(data, tuple) else data or {{}})
+    elif hasattr(value, "_repr_html_"):
+        html = value._repr_html_()
+        if html:
+            bundle["text/html"] = html
+    bundle.setdefault("text/plain", repr(value))
+    return bundle
+
+def _sandbox_display(value, source="display"):
+    global _sandbox_rich_outputs
+    if value is None or _sandbox_rich_outputs >= {max_rich_outputs}:
+        return
+    try:
+        bundle = _sandbox_mimebundle(value)
+    except Exception as error:
+        bundle = {{"text/plain": f"<could not render {{type(value).__name__}}: {{error}}>"}}
+    if not bundle:
+        return
+    # Drop representations that would blow up the response, keeping at least text/plain
+    bundle = {{
+        mime: data for mime, data in bundle.items()
+        if mime == "text/plain" or len(data if isinstance(data, str) else _sandbox_json.dumps(data, default=str)) <= {RICH_OUTPUT_MAX_BYTES}
+    }}
+    if len(bundle.get("text/plain", "")) > {RICH_OUTPUT_MAX_BYTES}:
+        bundle["text/plain"] = bundle["text/plain"][:{RICH_OUTPUT_MAX_BYTES}] + "..."
+    _sandbox_rich_outputs += 1
+    _sandbox_send({{"type": "display", "source": source, "data": bundle}})
+
+def display(*values):
+    """Show values as rich output, like IPython.display.display."""
+    for value in values:
+        _sandbox_display(value)
+
+def _sandbox_plotly_show(fig, *args, **kwargs):
+    _sandbox_display(fig, "show")
+
+def _sandbox_patch_plotly(plotly_io):
+    # fig.show() goes through plotly.io.show; without this it would try to open a browser
+    plotly_io.show = _sandbox_plotly_show
+
+_sandbox_patches = {{"matplotlib.pyplot": _sandbox_patch_pyplot, "plotly.io": _sandbox_patch_plotly}}
+
+class _SandboxImportHook:
+    """Applies the patches above as soon as their module is imported, without importing it up front."""
+    
+    def find_spec(self, name, path, target=None):
+        patch = _sandbox_patches.pop(name, None)
+        if patch is None:
+            return None
+        if not _sandbox_patches:
+            sys.meta_path.remove(self)
+        import importlib.util as _sandbox_importlib_util
+        spec = _sandbox_importlib_util.find_spec(name)
+        if spec is not None and spec.loader is not None:
+            exec_module = spec.loader.exec_module
+            def patched_exec_module(module):
+                exec_module(module)
+                patch(module)
+            spec.loader.exec_module = patched_exec_module
+        return spec
+
+for _sandbox_module_name in list(_sandbox_patches):
+    if _sandbox_module_name in sys.modules:
+        _sandbox_patches.pop(_sandbox_module_name)(sys.modules[_sandbox_module_name])
+# A session's interpreter may still hold the hook of an earlier execution
+sys.meta_path[:] = [finder for finder in sys.meta_path if type(finder).__name__ != "_SandboxImportHook"]
+if _sandbox_patches:
+    sys.meta_path.insert(0, _SandboxImportHook())
+
+# User code is compiled on its own so errors and tracebacks carry its own line numbers
+_sandbox_user_source = {code!r}
+_sandbox_linecache.cache[{USER_CODE_FILENAME!r}] = (
+    len(_sandbox_user_source), None, _sandbox_user_source.splitlines(True), {USER_CODE_FILENAME!r}
+)
+
+# The user code gets a namespace of its own, which a session keeps between executions, so the
+# side channel and the wrapper's helpers and modules are not in its scope
+_sandbox_user_globals = globals().setdefault("_sandbox_user_globals", {{"__name__": "__main__", "__builtins__": __builtins__}})
+_sandbox_user_globals["display"] = display
+# Uploaded datasets requested for this execution, by file name
+_sandbox_user_globals["DATASETS"] = {datasets or {}!r}
+
+# Opt-in profiling; nothing is imported or started when profile is off
+_sandbox_profiler = None
+_sandbox_stack_sampler = None
+# Set once the profiler is enabled; code that fails to parse has no profile to report
+_sandbox_profiling = False
+if {profile}:
+    import cProfile as _sandbox_cprofile
+    import pstats as _sandbox_pstats
+    import threading as _sandbox_threading
+    
+    class _SandboxStackSampler:
+        """Samples the main thread's stack from inside the user code into collapsed stacks."""
+        
+        def __init__(self, interval):
+            self.interval = interval
+            self.counts = {{}}
+            self.thread_id = _sandbox_threading.main_thread().ident
+            self.stopped = _sandbox_threading.Event()
+            self.thread = _sandbox_threading.Thread(target=self.run, daemon=True)
+        
+        def run(self):
+            while not self.stopped.wait(self.interval):
+                frame = sys._current_frames().get(self.thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{{code.co_name}} ({{os.path.basename(code.co_filename)}}:{{code.co_firstlineno}})")
+                    if code.co_filename == {USER_CODE_FILENAME!r} and code.co_name == "<module>":
+                        key = ";".join(reversed(stack))
+                        self.counts[key] = self.counts.get(key, 0) + 1
+                        break
+                    frame = frame.f_back
+        
+        def stop(self, path):
+            self.stopped.set()
+            if self.thread.ident is not None:
+                self.thread.join()
+            with open(path, "w") as collapsed:
+                for key, count in self.counts.items():
+                    collapsed.write(f"{{key}} {{count}}\\n")
+    
+    def _sandbox_profile_entries(stats, sort_key):
+        rows = [
+            {{"function": name, "filename": filename, "line": line, "calls": calls,
+              "self_seconds": round(self_time, 6), "cumulative_seconds": round(cumulative_time, 6)}}
+            for (filename, line, name), (_, calls, self_time, cumulative_time, _) in stats.items()
+            # The wrapper's exec/eval of the user code (which cannot call them itself) and its disable()
+            if name not in ("<built-in method builtins.exec>", "<built-in method builtins.eval>")
+            and not name.startswith("<method 'disable' of '_lsprof.Profiler'")
+        ]
+        rows.sort(key=lambda row: row[sort_key], reverse=True)
+        return rows[:{profile_top_n}]
     
-    # Check for matplotlib plots
+    def _sandbox_send_profile():
+        collapsed = None
+        if _sandbox_stack_sampler:
+            collapsed = "profile.collapsed"
+            _sandbox_stack_sampler.stop(os.path.join(_sandbox_artifact_dir, collapsed))
+        stats = _sandbox_pstats.Stats(_sandbox_profiler).stats
+        _sandbox_send({{
+            "type": "profile",
+            "wall_seconds": _sandbox_profile_wall_seconds,
+            "cpu_seconds": _sandbox_profile_cpu_seconds,
+            "top_cumulative": _sandbox_profile_entries(stats, "cumulative_seconds"),
+            "top_self": _sandbox_profile_entries(stats, "self_seconds"),
+            "collapsed": collapsed
+        }})
+    
+    _sandbox_profiler = _sandbox_cprofile.Profile()
+    if {profile_flamegraph}:
+        _sandbox_stack_sampler = _SandboxStackSampler(0.005)
+
+_sandbox_user_code_start = _sandbox_time.perf_counter()
+try:
+    _sandbox_tree = _sandbox_ast.parse(_sandbox_user_source, {USER_CODE_FILENAME!r})
+    _sandbox_last_expression = None
+    if {rich_output} and _sandbox_tree.body and isinstance(_sandbox_tree.body[-1], _sandbox_ast.Expr):
+        # Evaluate a trailing expression separately so its value can be shown, as in a notebook
+        _sandbox_last_expression = _sandbox_ast.Expression(_sandbox_tree.body.pop().value)
+    _sandbox_user_code = compile(_sandbox_tree, {USER_CODE_FILENAME!r}, "exec")
+    if _sandbox_last_expression is not None:
+        _sandbox_last_expression = compile(_sandbox_last_expression, {USER_CODE_FILENAME!r}, "eval")
+    if _sandbox_profiler:
+        if _sandbox_stack_sampler:
+            _sandbox_stack_sampler.thread.start()
+        _sandbox_profile_wall_start = _sandbox_time.perf_counter()
+        _sandbox_profile_cpu_start = _sandbox_time.process_time()
+        _sandbox_profiler.enable()
+        _sandbox_profiling = True
+    # Only the user code is profiled: rendering its last value and encoding figures are not
     try:
-        import matplotlib.pyplot as plt
-        if plt.get_fignums():  # Check if any figures exist
-            for fig_num in plt.get_fignums():
-                fig = plt.figure(fig_num)
-                # Save plot to base64
-                buffer = io.BytesIO()
-                fig.savefig(buffer, format='png', bbox_inches='tight', dpi=150)
-                buffer.seek(0)
-                plot_base64 = base64.b64encode(buffer.getvalue()).decode()
-                plot_data.append(plot_base64)
-                buffer.close()
-            plt.close('all')  # Close all figures to free memory
-            
-            if plot_data:
-                print(f"\\n__PLOTS__: {{len(plot_data)}} plot(s) generated")
-                for i, plot in enumerate(plot_data):
-                    print(f"__PLOT_{{i}}__: {{plot}}")
-    except ImportError:
-        pass  # matplotlib not used
-    except Exception as plot_error:
-        print(f"__PLOT_ERROR__: {{str(plot_error)}}")
+        exec(_sandbox_user_code, _sandbox_user_globals)
+        if _sandbox_last_expression is not None:
+            _sandbox_last_value = eval(_sandbox_last_expression, _sandbox_user_globals)
+    finally:
+        if _sandbox_profiling:
+            _sandbox_profiler.disable()
+            _sandbox_profile_wall_seconds = _sandbox_time.perf_counter() - _sandbox_profile_wall_start
+            _sandbox_profile_cpu_seconds = _sandbox_time.process_time() - _sandbox_profile_cpu_start
+    if _sandbox_last_expression is not None:
+        _sandbox_display(_sandbox_last_value, "result")
+    # Figures encoded by plt.show() while the code ran are counted as plot_encode, not user_code
+    _sandbox_timings["user_code"] = _sandbox_time.perf_counter() - _sandbox_user_code_start - _sandbox_timings["plot_encode"]
+    
+    # Encode the figures still open; matplotlib is not imported if the code never used it
+    if "matplotlib.pyplot" in sys.modules:
+        try:
+            _sandbox_save_open_figures()
+        except Exception as _sandbox_plot_error:
+            print(f"[plot capture failed: {{str(_sandbox_plot_error)}}]")
+    if _sandbox_plots_skipped:
+        print(f"[{{_sandbox_plots_skipped}} figure(s) not captured: max_plots is {max_plots}]")
     
     # Memory usage after execution
-    final_memory = process.memory_info().rss / 1024 / 1024
-    memory_used = final_memory - initial_memory
-    print(f"\\n__MEMORY_USED__: {{memory_used:.2f}} MB")
-    
-except Exception as e:
-    print(f"__ERROR__: {{str(e)}}")
-    print(f"__TRACEBACK__:")
-    traceback.print_exc()
-'''
-        temp_file.write(safe_code)
-        temp_file_path = temp_file.name
+    _sandbox_final_memory = _sandbox_process.memory_info().rss / 1024 / 1024
+    _sandbox_memory_used = _sandbox_final_memory - _sandbox_initial_memory
     
+except MemoryError:
+    _sandbox_send({{"type": "memory_limit_exceeded"}})
+except Exception as _sandbox_error:
+    # Start the traceback at the first user code frame, skipping the wrapper and, for a
+    # SyntaxError, ast.parse; errors raised outside the user code keep all but the wrapper's frame
+    _sandbox_tb = _sandbox_error.__traceback__.tb_next
+    _sandbox_user_tb = _sandbox_tb
+    while _sandbox_user_tb is not None and _sandbox_user_tb.tb_frame.f_code.co_filename != {USER_CODE_FILENAME!r}:
+        _sandbox_user_tb = _sandbox_user_tb.tb_next
+    if _sandbox_user_tb is not None or (isinstance(_sandbox_error, SyntaxError) and _sandbox_error.filename == {USER_CODE_FILENAME!r}):
+        _sandbox_tb = _sandbox_user_tb
+    traceback.print_exception(type(_sandbox_error), _sandbox_error, _sandbox_tb)
+    _sandbox_frames = [
+        {{"filename": _sandbox_frame.filename, "line": _sandbox_frame.lineno, "function": _sandbox_frame.name, "code": _sandbox_frame.line or None}}
+        for _sandbox_frame in traceback.extract_tb(_sandbox_tb)
+    ]
+    _sandbox_user_lines = [_sandbox_frame["line"] for _sandbox_frame in _sandbox_frames if _sandbox_frame["filename"] == {USER_CODE_FILENAME!r}]
+    if isinstance(_sandbox_error, SyntaxError) and _sandbox_error.filename == {USER_CODE_FILENAME!r}:
+        _sandbox_user_lines.append(_sandbox_error.lineno)
+    _sandbox_send({{
+        "type": "error",
+        "error_type": type(_sandbox_error).__name__,
+        "message": str(_sandbox_error),
+        "line": _sandbox_user_lines[-1] if _sandbox_user_lines else None,
+        "frames": _sandbox_frames
+    }})
+finally:
+    if _sandbox_profiling:
+        try:
+            _sandbox_send_profile()
+        except Exception as _sandbox_profile_error:
+            print(f"[profiling failed: {{str(_sandbox_profile_error)}}]", file=sys.stderr)
+    _sandbox_timings.setdefault("user_code", _sandbox_time.perf_counter() - _sandbox_user_code_start - _sandbox_timings["plot_encode"])
+    # Memory private to this process; pages shared with a pre-warmed worker are not counted
+    try:
+        _sandbox_full_memory = _sandbox_process.memory_full_info()
+        _sandbox_unique_memory = _sandbox_full_memory.uss / 1024 / 1024
+        _sandbox_shared_memory = (_sandbox_full_memory.rss - _sandbox_full_memory.uss) / 1024 / 1024
+    except Exception:
+        _sandbox_unique_memory = _sandbox_shared_memory = None
+    _sandbox_send({{
+        "type": "stats",
+        "memory_used_mb": _sandbox_memory_used,
+        "unique_memory_mb": _sandbox_unique_memory,
+        "shared_memory_mb": _sandbox_shared_memory,
+        "peak_memory_mb": _sandbox_resource.getrusage(_sandbox_resource.RUSAGE_SELF).ru_maxrss / 1024 if _sandbox_resource else None,
+        "cpu_time_seconds": _sandbox_cpu_time() - _sandbox_cpu_start if _sandbox_resource else None,
+        "timings": _sandbox_timings
+    }})
+'''
+    plot_artifacts = None
+    output_artifacts = None
+    profile_report = None
+    pooled = worker is None
+    if pooled:
+        worker = worker_pool.acquire() if worker_pool else None
+    EXECUTIONS_TOTAL.inc()
     start_time = datetime.now()
+    spawn_started_at = time.time()
     
     try:
-        # Execute the code with resource limits
-        process = subprocess.Popen(
-            [sys.executable, temp_file_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            preexec_fn=None if os.name == 'nt' else os.setsid
-        )
+        process = None
+        if worker:
+            # Fork a child from a worker that already has the heavy libraries imported
+            try:
+                process = await worker.spawn(safe_code)
+            except OSError as e:
+                if not pooled:
+                    raise
+                logger.warning(f"Pre-warmed worker unavailable, starting a fresh interpreter: {str(e)}")
+        
+        if process is None:
+            # Hand the script to a fresh interpreter over stdin, nothing is written to disk
+            channel_read, channel_write = os.pipe()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable, "-",
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    pass_fds=(channel_write,),
+                    env={**os.environ, CHANNEL_FD_ENV: str(channel_write)},
+                    start_new_session=os.name != 'nt'
+                )
+            except BaseException:
+                os.close(channel_read)
+                raise
+            finally:
+                os.close(channel_write)
+            process.channel = await open_read_pipe(channel_read)
+            process.stdin.write(safe_code.encode('utf-8'))
+            await process.stdin.drain()
+            process.stdin.close()
         
+        output_buffer = OutputBuffer(max_output_bytes, os.path.join(artifact_dir, "stdout.log") if spill_output else None)
+        stderr_buffer = OutputBuffer(max_output_bytes, os.path.join(artifact_dir, "stderr.log") if spill_output else None)
+        messages: List[Dict[str, Any]] = []  # Sent by the wrapper over the side channel
+        streamed_bytes = {"stdout": 0, "stderr": 0}
+        
+        async def emit_output(stream_name: str, text: str) -> None:
+            """Forward output to the event callback, up to STREAM_MAX_OUTPUT_BYTES per stream."""
+            sent = streamed_bytes[stream_name]
+            if sent >= STREAM_MAX_OUTPUT_BYTES:
+                return
+            data = text.encode('utf-8')
+            streamed_bytes[stream_name] = sent + len(data)
+            if sent + len(data) > STREAM_MAX_OUTPUT_BYTES:
+                text = data[:STREAM_MAX_OUTPUT_BYTES - sent].decode('utf-8', errors='ignore')
+                await on_event(stream_name, {"data": text})
+                await on_event("truncated", {"stream": stream_name, "limit_bytes": STREAM_MAX_OUTPUT_BYTES})
+            else:
+                await on_event(stream_name, {"data": text})
+        
+        async def handle_stdout(lines: List[str]) -> None:
+            if capture_output:
+                output_buffer.write(''.join(lines))
+            if on_event:
+                await emit_output("stdout", ''.join(lines))
+        
+        async def handle_message(message: Dict[str, Any]) -> None:
+            if message.get("type") == "plot" and not PLOT_FILE_PATTERN.match(str(message.get("name"))):
+                return
+            messages.append(message)
+            if on_event and message.get("type") == "display":
+                await on_event("display", {"source": message.get("source"), "data": message.get("data")})
+            if on_event and message.get("type") == "plot":
+                _, artifacts = await asyncio.to_thread(
+                    collect_plots, artifact_dir, directory_id, [message["name"]], False
+                )
+                for artifact in artifacts or []:
+                    await on_event("plot", artifact)
+        
+        async def handle_stderr(lines: List[str]) -> None:
+            stderr_buffer.write(''.join(lines))
+            if on_event:
+                await emit_output("stderr", ''.join(lines))
+        
+        sampler = asyncio.create_task(sample_memory(process.pid, on_event)) if on_event else None
+        
+        streams = asyncio.gather(
+            read_lines(process.stdout, handle_stdout),
+            read_lines(process.stderr, handle_stderr),
+            read_messages(process.channel, handle_message),
+            process.wait()
+        )
         try:
-            stdout, stderr = process.communicate(timeout=timeout)
+            await asyncio.wait_for(streams, timeout=timeout)
             execution_time = (datetime.now() - start_time).total_seconds()
+            parse_start = time.perf_counter()
+            stderr = stderr_buffer.getvalue()
             
-            # Parse output for memory usage and plots
+            # Results reported by the wrapper over the side channel
+            timings: Dict[str, float] = {}
             memory_used = None
-            output_lines = []
+            unique_memory = None
+            shared_memory = None
+            peak_memory = getattr(process, 'peak_memory_mb', None)
+            memory_limit_exceeded = False
             error_lines = []
-            plots = []
+            error_details = None
+            plot_metadata = []
+            rich_outputs = []
+            profile_report = None
+            cpu_time = None
             
-            for line in stdout.split('\n'):
-                if line.startswith('__MEMORY_USED__:'):
-                    try:
-                        memory_used = float(line.split(':')[1].strip().replace(' MB', ''))
-                    except:
-                        pass
-                elif line.startswith('__ERROR__:'):
-                    error_lines.append(line.replace('__ERROR__: ', ''))
-                elif line.startswith('__TRACEBACK__:'):
+            for message in messages:
+                kind = message.get("type")
+                if kind == "stats":
+                    memory_used = message.get("memory_used_mb")
+                    unique_memory = message.get("unique_memory_mb")
+                    shared_memory = message.get("shared_memory_mb")
+                    cpu_time = message.get("cpu_time_seconds")
+                    if peak_memory is None:
+                        peak_memory = message.get("peak_memory_mb")
+                    reported = dict(message.get("timings") or {})
+                    if "started_at" in reported:
+                        timings["spawn"] = max(0.0, reported.pop("started_at") - spawn_started_at)
+                    timings.update(reported)
+                elif kind == "memory_limit_exceeded":
+                    memory_limit_exceeded = True
+                    error_lines.append(f"Memory limit exceeded: execution needed more than {memory_limit_mb} MB")
+                elif kind == "error":
+                    error_details = {
+                        "type": message.get("error_type", "Exception"),
+                        "message": message.get("message", ""),
+                        "line": message.get("line"),
+                        "frames": message.get("frames") or []
+                    }
+                    error_lines.append(error_details["message"])
                     error_lines.extend(stderr.split('\n'))
-                elif line.startswith('__PLOT_') and '__:' in line:
-                    # Extract plot data
-                    try:
-                        plot_data = line.split(':', 1)[1].strip()
-                        plots.append(plot_data)
-                    except:
-                        pass
-                elif line.startswith('__PLOTS__:'):
-                    pass  # Skip plot count line
-                else:
-                    output_lines.append(line)
+                elif kind == "display" and isinstance(message.get("data"), dict):
+                    rich_outputs.append({"source": str(message.get("source")), "data": message["data"]})
+                elif kind == "plot" and os.path.isfile(os.path.join(artifact_dir, message["name"])):
+                    plot_metadata.append({key: value for key, value in message.items() if key != "type"})
+                elif kind == "profile":
+                    profile_report = {key: message.get(key) for key in ("wall_seconds", "cpu_seconds", "top_cumulative", "top_self")}
+                    collapsed_path = os.path.join(artifact_dir, "profile.collapsed")
+                    if message.get("collapsed") == "profile.collapsed" and os.path.isfile(collapsed_path):
+                        profile_report["flamegraph"] = artifact_reference(directory_id, "profile.collapsed", collapsed_path)
             
             # Clean up output
-            output = '\n'.join(output_lines).strip()
+            output = output_buffer.getvalue().strip()
             error = '\n'.join(error_lines).strip() if error_lines else stderr.strip()
             
             success = process.returncode == 0 and not error
+            plots, plot_artifacts = await asyncio.to_thread(
+                collect_plots, artifact_dir, directory_id, [plot["name"] for plot in plot_metadata], inline_plots
+            )
+            output_artifacts = [
+                artifact_reference(directory_id, name, os.path.join(artifact_dir, name))
+                for name, buffer in (("stdout.log", output_buffer), ("stderr.log", stderr_buffer))
+                if buffer.close()
+            ] or None
+            timings["output_parse"] = time.perf_counter() - parse_start
+            
+            if memory_limit_exceeded:
+                MEMORY_LIMIT_KILLS_TOTAL.inc()
+            if unique_memory is not None:
+                UNIQUE_MEMORY_BYTES.observe(unique_memory * 1024 * 1024)
+            if cpu_time is not None:
+                CPU_SECONDS_TOTAL.inc(cpu_time)
+            for phase, histogram in (("spawn", SPAWN_SECONDS), ("user_code", USER_CODE_SECONDS),
+                                     ("plot_encode", PLOT_ENCODE_SECONDS), ("output_parse", OUTPUT_PARSE_SECONDS)):
+                if phase in timings:
+                    histogram.observe(timings[phase])
             
             return {
                 "success": success,
@@ -229,20 +1896,51 @@ except Exception as e:
                 "error": error if error else None,
                 "execution_time": execution_time,
                 "memory_used_mb": memory_used,
-                "plots": plots if plots else None
+                "peak_memory_mb": peak_memory,
+                "unique_memory_mb": unique_memory,
+                "shared_memory_mb": shared_memory,
+                "memory_limit_exceeded": memory_limit_exceeded,
+                "cpu_time_seconds": cpu_time,
+                "cpu_threads": cpu_threads,
+                "cpu_cores": cpu_cores,
+                "plots": plots,
+                "plot_artifacts": plot_artifacts,
+                "truncated": output_buffer.truncated or stderr_buffer.truncated,
+                "output_bytes": output_buffer.total_bytes,
+                "error_bytes": stderr_buffer.total_bytes,
+                "output_artifacts": output_artifacts,
+                "timings": timings,
+                "error_details": error_details,
+                "plot_metadata": plot_metadata or None,
+                "rich_outputs": rich_outputs or None,
+                "profile": profile_report
             }
             
-        except subprocess.TimeoutExpired:
-            process.kill()
-            process.wait()
+        except asyncio.TimeoutError:
+            TIMEOUTS_TOTAL.inc()
+            await kill_process_group(process)
             return {
                 "success": False,
                 "output": "",
                 "error": f"Code execution timed out after {timeout} seconds",
                 "execution_time": timeout,
                 "memory_used_mb": None,
-                "plots": None
+                "peak_memory_mb": None,
+                "memory_limit_exceeded": False,
+                "plots": None,
+                "plot_artifacts": None
             }
+        except asyncio.CancelledError:
+            # The caller went away or cancelled the execution; do not leave the script running
+            if streams.done() and not streams.cancelled():
+                streams.exception()  # retrieve it so it is not logged as never retrieved
+            await kill_process_group(process)
+            raise
+        finally:
+            if sampler:
+                sampler.cancel()
+            output_buffer.close()
+            stderr_buffer.close()
             
     except Exception as e:
         return {
@@ -251,13 +1949,282 @@ except Exception as e:
             "error": f"Execution error: {str(e)}",
             "execution_time": (datetime.now() - start_time).total_seconds(),
             "memory_used_mb": None,
-            "plots": None
+            "peak_memory_mb": None,
+            "memory_limit_exceeded": False,
+            "plots": None,
+            "plot_artifacts": None
         }
     finally:
-        # Clean up temporary file
+        if worker and pooled:
+            worker_pool.release(worker)
+        # Keep the artifact directory only if the response references it
+        if not plot_artifacts and not output_artifacts and not (profile_report and profile_report.get("flamegraph")):
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+
+class Session:
+    """A sandboxed worker whose namespace persists across executions."""
+    
+    def __init__(self, worker: PrewarmedWorker, memory_limit_mb: int):
+        self.id = uuid.uuid4().hex
+        self.worker = worker
+        self.memory_limit_mb = memory_limit_mb
+        self.created_at = datetime.now()
+        self.last_used_at = self.created_at
+        self.executions = 0
+        self.lock = asyncio.Lock()  # one execution at a time per namespace
+    
+    def info(self) -> SessionInfo:
+        return SessionInfo(
+            session_id=self.id,
+            created_at=self.created_at.isoformat(),
+            last_used_at=self.last_used_at.isoformat(),
+            memory_limit_mb=self.memory_limit_mb,
+            executions=self.executions,
+            idle_timeout=SESSION_IDLE_TIMEOUT_SECONDS
+        )
+
+class SessionManager:
+    """Creates, looks up and evicts sessions."""
+    
+    def __init__(self, max_sessions: int, idle_timeout: int):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions: Dict[str, Session] = {}
+        self.starting = 0
+    
+    async def create(self, memory_limit_mb: int) -> Session:
+        if not hasattr(os, 'fork'):
+            raise HTTPException(status_code=501, detail="Sessions are not supported on this platform")
+        if len(self.sessions) + self.starting >= self.max_sessions:
+            raise HTTPException(status_code=429, detail=f"Maximum number of sessions ({self.max_sessions}) reached")
+        self.starting += 1
         try:
-            os.unlink(temp_file_path)
-        except:
+            worker = await PrewarmedWorker.start(WORKER_WARM_MODULES, mode="session", memory_limit_mb=memory_limit_mb)
+        finally:
+            self.starting -= 1
+        session = Session(worker, memory_limit_mb)
+        self.sessions[session.id] = session
+        return session
+    
+    def get(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        return session
+    
+    async def close(self, session_id: str) -> None:
+        session = self.sessions.pop(session_id, None)
+        if session:
+            await session.worker.stop()
+    
+    async def evict_idle(self) -> None:
+        cutoff = datetime.now() - timedelta(seconds=self.idle_timeout)
+        for session in list(self.sessions.values()):
+            if not session.worker.alive or (session.last_used_at < cutoff and not session.lock.locked()):
+                logger.info(f"Closing idle session {session.id}")
+                await self.close(session.id)
+    
+    async def shutdown(self) -> None:
+        await asyncio.gather(*(self.close(session_id) for session_id in list(self.sessions)), return_exceptions=True)
+
+session_manager = SessionManager(MAX_SESSIONS, SESSION_IDLE_TIMEOUT_SECONDS)
+
+class DatasetStore:
+    """Content-addressed store of uploaded files: DATASETS_DIR/<sha256>/<name>.
+    
+    Uploading the same bytes again reuses the stored copy. Stored files are made read-only.
+    CSV uploads get a Parquet copy written in the background when pyarrow is installed,
+    so repeated analyses can skip CSV parsing.
+    """
+    
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.conversions: Dict[str, asyncio.Task] = {}
+    
+    @staticmethod
+    def safe_name(filename: Optional[str]) -> str:
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.basename(filename or ""))
+        return name.lstrip(".") or "data"
+    
+    def store(self, source, filename: Optional[str]) -> DatasetInfo:
+        """Copy an uploaded file into the store, hashing it on the way."""
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.root, prefix=".upload-", delete=False) as staging:
+            try:
+                while True:
+                    chunk = source.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise HTTPException(status_code=413, detail=f"Dataset is larger than {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    staging.write(chunk)
+            except BaseException:
+                staging.close()
+                os.unlink(staging.name)
+                raise
+        
+        dataset_id = digest.hexdigest()
+        directory = os.path.join(self.root, dataset_id)
+        if os.path.isdir(directory):
+            os.unlink(staging.name)
+            return self.get(dataset_id)
+        
+        name = self.safe_name(filename)
+        os.makedirs(directory)
+        path = os.path.join(directory, name)
+        os.replace(staging.name, path)
+        os.chmod(path, 0o444)
+        with open(os.path.join(directory, ".meta.json"), "w") as meta_file:
+            json.dump({"name": name, "size_bytes": size, "created_at": datetime.now().isoformat()}, meta_file)
+        os.chmod(directory, 0o555)
+        return self.get(dataset_id)
+    
+    def load_meta(self, dataset_id: str) -> Dict[str, Any]:
+        if not DATASET_ID_PATTERN.match(dataset_id):
+            raise HTTPException(status_code=404, detail=f"Dataset {dataset_id} not found")
+        try:
+            with open(os.path.join(self.root, dataset_id, ".meta.json")) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            raise HTTPException(status_code=404, detail=f"Dataset {dataset_id} not found")
+    
+    def parquet_path(self, dataset_id: str, name: str) -> str:
+        return os.path.join(self.root, dataset_id, os.path.splitext(name)[0] + ".parquet")
+    
+    def get(self, dataset_id: str) -> DatasetInfo:
+        meta = self.load_meta(dataset_id)
+        return DatasetInfo(
+            id=dataset_id,
+            name=meta["name"],
+            size_bytes=meta["size_bytes"],
+            created_at=meta["created_at"],
+            parquet=meta["name"].lower().endswith(".csv") and os.path.isfile(self.parquet_path(dataset_id, meta["name"]))
+        )
+    
+    def list(self) -> List[DatasetInfo]:
+        if not os.path.isdir(self.root):
+            return []
+        datasets = []
+        for entry in os.scandir(self.root):
+            if DATASET_ID_PATTERN.match(entry.name):
+                try:
+                    datasets.append(self.get(entry.name))
+                except HTTPException:
+                    pass
+        return sorted(datasets, key=lambda dataset: dataset.created_at)
+    
+    def delete(self, dataset_id: str) -> None:
+        self.load_meta(dataset_id)
+        directory = os.path.join(self.root, dataset_id)
+        # Executions that already opened a file keep reading it after the unlink
+        os.chmod(directory, 0o755)
+        shutil.rmtree(directory, ignore_errors=True)
+    
+    def resolve(self, dataset_ids: Optional[List[str]]) -> Dict[str, str]:
+        """Map the file names an execution sees in DATASETS to paths in the store."""
+        paths = {}
+        for dataset_id in dataset_ids or []:
+            meta = self.load_meta(dataset_id)
+            paths[meta["name"]] = os.path.join(self.root, dataset_id, meta["name"])
+            parquet_path = self.parquet_path(dataset_id, meta["name"])
+            if meta["name"].lower().endswith(".csv") and os.path.isfile(parquet_path):
+                paths.setdefault(os.path.basename(parquet_path), parquet_path)
+        return paths
+    
+    def convert_to_parquet(self, dataset_id: str) -> None:
+        """Write a Parquet copy of a CSV dataset, batch by batch so memory stays bounded."""
+        try:
+            import pyarrow.csv
+            import pyarrow.parquet
+        except ImportError:
+            return
+        meta = self.load_meta(dataset_id)
+        directory = os.path.join(self.root, dataset_id)
+        target = self.parquet_path(dataset_id, meta["name"])
+        staging = os.path.join(directory, ".parquet.tmp")
+        try:
+            os.chmod(directory, 0o755)
+            reader = pyarrow.csv.open_csv(os.path.join(directory, meta["name"]))
+            with pyarrow.parquet.ParquetWriter(staging, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+            os.replace(staging, target)
+            os.chmod(target, 0o444)
+        except Exception as e:
+            logger.warning(f"Could not convert dataset {dataset_id} to Parquet: {str(e)}")
+            if os.path.exists(staging):
+                os.unlink(staging)
+        finally:
+            if os.path.isdir(directory):
+                os.chmod(directory, 0o555)
+    
+    def schedule_conversion(self, dataset: DatasetInfo) -> None:
+        if dataset.name.lower().endswith(".csv") and not dataset.parquet and dataset.id not in self.conversions:
+            task = asyncio.create_task(asyncio.to_thread(self.convert_to_parquet, dataset.id))
+            self.conversions[dataset.id] = task
+            task.add_done_callback(lambda _: self.conversions.pop(dataset.id, None))
+
+dataset_store = DatasetStore(DATASETS_DIR, MAX_DATASET_BYTES)
+
+@app.on_event("startup")
+async def start_worker_pool():
+    """Warm up the interpreter pool in the background so startup is not delayed."""
+    if worker_pool:
+        worker_pool.start()
+
+@app.on_event("startup")
+async def load_library_catalog():
+    """Read the installed packages in the background so the first /libraries call is fast."""
+    asyncio.create_task(asyncio.to_thread(library_catalog.load))
+
+@app.on_event("startup")
+async def start_artifact_sweeper():
+    """Periodically remove expired plot artifacts."""
+    async def sweep_forever():
+        while True:
+            await asyncio.to_thread(sweep_artifacts)
+            await asyncio.sleep(60)
+    asyncio.create_task(sweep_forever())
+
+@app.on_event("startup")
+async def start_session_reaper():
+    """Periodically close sessions that have been idle for too long."""
+    async def reap_forever():
+        while True:
+            await asyncio.sleep(30)
+            await session_manager.evict_idle()
+    asyncio.create_task(reap_forever())
+
+@app.on_event("startup")
+async def start_job_workers():
+    """Open the job store and start draining it; expired jobs are swept periodically."""
+    await job_store.start()
+    
+    async def sweep_forever():
+        while True:
+            await asyncio.to_thread(job_store.sweep)
+            await asyncio.sleep(60)
+    asyncio.create_task(sweep_forever())
+
+@app.on_event("shutdown")
+async def stop_worker_pool():
+    # Running jobs go back to the queue, to be run again after a restart
+    await job_store.stop()
+    await executions.cancel_all()
+    if worker_pool:
+        await worker_pool.shutdown()
+    await session_manager.shutdown()
+    # Anything still alive below this process (e.g. grandchildren that left their process group) is an orphan
+    for child in psutil.Process().children(recursive=True):
+        try:
+            child.kill()
+            ORPHANS_KILLED_TOTAL.inc()
+        except psutil.Error:
             pass
 
 @app.get("/")
@@ -268,8 +2235,17 @@ async def root():
         "version": "1.0.0",
         "endpoints": [
             "/execute - Execute Python code",
+            "/execute/stream - Execute Python code and stream output as it happens",
+            "/execute/batch - Execute many independent snippets in one request",
+            "/jobs - Queue an execution and poll /jobs/{id} for its result (POST /jobs/batch for many)",
+            "/executions/{id} - Cancel a queued or running execution (DELETE)",
+            "/sessions - Create a persistent session (POST), then /sessions/{id}/execute",
+            "/artifacts/{id} - Download a plot artifact",
+            "/datasets - Upload a data file (POST) and reference it from executions by id",
+            "/cache/stats - Result cache statistics",
+            "/metrics - Prometheus metrics",
             "/health - Health check",
-            "/libraries - List available libraries",
+            "/libraries - Installed packages with versions (?check=name1,name2 for importability)",
             "/docs - API documentation"
         ]
     }
@@ -280,69 +2256,1062 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "service": "code-runner-sandbox"
+        "service": "code-runner-sandbox",
+        "active_executions": admission.running,
+        "max_concurrent_executions": MAX_CONCURRENT_EXECUTIONS,
+        "admission": admission.stats(),
+        "worker_pool": {
+            "size": worker_pool.size,
+            "idle": len(worker_pool.idle),
+            "busy": worker_pool.busy,
+            "starting": worker_pool.starting,
+            "warm_worker_rss_mb": worker_pool.warm_memory_mb()
+        } if worker_pool else None,
+        "sessions": len(session_manager.sessions),
+        "jobs": await asyncio.to_thread(job_store.counts) if job_store.connection else None
     }
 
-@app.post("/execute", response_model=CodeExecutionResponse)
-async def execute_code(request: CodeExecutionRequest):
-    """Execute Python code in a secure sandbox environment."""
+def normalize_package_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+class LibraryCatalog:
+    """Installed packages read from importlib.metadata once, with the rendered /libraries body.
     
-    logger.info(f"Executing code with timeout: {request.timeout}s, memory limit: {request.memory_limit_mb}MB")
+    The sandbox runs the same interpreter as the API, so what is installed here is what the
+    executed code can import.
+    """
+    
+    def __init__(self):
+        self.libraries: Optional[List[LibraryInfo]] = None
+        self.body: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.by_name: Dict[str, LibraryInfo] = {}
+    
+    def load(self) -> None:
+        if self.libraries is not None:
+            return
+        modules_by_distribution: Dict[str, List[str]] = {}
+        for module, distributions in importlib.metadata.packages_distributions().items():
+            if module.startswith("_") or not module.isidentifier():
+                continue
+            for distribution in distributions:
+                modules_by_distribution.setdefault(normalize_package_name(distribution), []).append(module)
+        
+        libraries = {}
+        for dist in importlib.metadata.distributions():
+            name = dist.metadata["Name"]
+            if not name or normalize_package_name(name) in libraries:
+                continue
+            libraries[normalize_package_name(name)] = LibraryInfo(
+                name=name,
+                version=dist.version,
+                description=dist.metadata["Summary"],
+                modules=sorted(modules_by_distribution.get(normalize_package_name(name), []))
+            )
+        
+        self.by_name = libraries
+        self.libraries = sorted(libraries.values(), key=lambda library: library.name.lower())
+        self.body = json.dumps({
+            "available_libraries": [library.model_dump() for library in self.libraries],
+            "total_count": len(self.libraries),
+            "python_version": sys.version.split()[0],
+            "note": "Installed packages. The Python standard library is also available, except restricted modules."
+        }).encode()
+        versions = "\n".join(f"{library.name}=={library.version}" for library in self.libraries)
+        self.etag = f'"{hashlib.sha256(versions.encode()).hexdigest()[:32]}"'
+    
+    def fingerprint(self) -> str:
+        """Identifies the installed package versions, so upgrades invalidate cached results."""
+        self.load()
+        return self.etag
+    
+    def check(self, name: str) -> Dict[str, Any]:
+        """Answer whether a module or package can be imported, without importing it."""
+        self.load()
+        library = self.by_name.get(normalize_package_name(name))
+        # Package names (scikit-learn, PyYAML) are answered for the module they provide
+        module = name
+        if library and library.modules and name.split(".")[0] not in library.modules:
+            module = library.modules[0]
+        if not all(part.isidentifier() for part in module.split(".")):
+            return {"importable": False, "restricted": False}
+        top_level = module.split(".")[0]
+        if top_level in RESTRICTED_IMPORTS:
+            return {"importable": False, "restricted": True, "module": module}
+        # Only the top-level package is located; resolving submodules would import their parents
+        importable = importlib.util.find_spec(top_level) is not None
+        if library is None:
+            library = next((lib for lib in self.libraries if top_level in lib.modules), None)
+        result = {"importable": importable, "restricted": False, "module": module}
+        if library:
+            result.update(package=library.name, version=library.version)
+        return result
+
+library_catalog = LibraryCatalog()
+
+class ResultCache:
+    """LRU cache of successful execution responses with a TTL.
+    
+    Concurrent requests for the same key share one execution instead of racing.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[str, tuple[float, CodeExecutionResponse]] = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def key_for(self, request: CodeExecutionRequest) -> str:
+        options = json.dumps(request.model_dump(exclude={"cache", "priority", "queue_timeout", "execution_id", "cpu_limit"}), sort_keys=True)
+        return hashlib.sha256(f"{library_catalog.fingerprint()}\n{options}".encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[CodeExecutionResponse]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self.entries[key]
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(key)
+        return response
+    
+    def put(self, key: str, response: CodeExecutionResponse) -> None:
+        self.entries[key] = (time.monotonic(), response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    @staticmethod
+    def cacheable(response: CodeExecutionResponse) -> bool:
+        # Artifacts expire on their own schedule, so results that reference them are not kept
+        return response.success and not response.plot_artifacts and not response.output_artifacts
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None
+        }
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_SECONDS)
+
+class AdmissionController:
+    """Admits executions while a CPU slot is free and their memory limits fit the budget.
+    
+    Everything else waits in a bounded queue ordered by priority class, then arrival. The head
+    of the queue is never overtaken, so large or low-priority requests cannot starve. A request
+    asking for more than the whole budget is admitted once nothing else is running.
+    """
+    
+    def __init__(self, max_concurrent: int, memory_budget_mb: int, max_queue_depth: int):
+        self.max_concurrent = max_concurrent
+        self.memory_budget_mb = memory_budget_mb
+        self.max_queue_depth = max_queue_depth
+        self.running = 0
+        self.memory_reserved_mb = 0
+        self.queue: List[list] = []
+        self.sequence = itertools.count()
+        # Moving average of execution durations, used to estimate Retry-After
+        self.average_duration = 1.0
+        self.rejected = 0
+        self.timed_out = 0
+    
+    def fits(self, memory_mb: int) -> bool:
+        if self.running >= self.max_concurrent:
+            return False
+        return self.running == 0 or self.memory_reserved_mb + memory_mb <= self.memory_budget_mb
+    
+    def retry_after(self) -> str:
+        waiting = len(self.queue) + 1
+        return str(max(1, math.ceil(self.average_duration * waiting / self.max_concurrent)))
+    
+    def admit(self, memory_mb: int) -> None:
+        self.running += 1
+        self.memory_reserved_mb += memory_mb
+    
+    def dispatch(self) -> None:
+        while self.queue and self.fits(self.queue[0][2]):
+            _, _, memory_mb, waiter = heapq.heappop(self.queue)
+            if not waiter.done():
+                self.admit(memory_mb)
+                waiter.set_result(None)
+    
+    async def acquire(self, memory_mb: int, priority: str, queue_timeout: float) -> int:
+        """Wait for a slot and return the memory reserved for it; raises 429/503 when saturated."""
+        memory_mb = min(memory_mb, self.memory_budget_mb)
+        if not self.queue and self.fits(memory_mb):
+            self.admit(memory_mb)
+            return memory_mb
+        if len(self.queue) >= self.max_queue_depth:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"Execution queue is full ({self.max_queue_depth} waiting)",
+                headers={"Retry-After": self.retry_after()}
+            )
+        
+        waiter = asyncio.get_running_loop().create_future()
+        entry = [PRIORITY_CLASSES[priority], next(self.sequence), memory_mb, waiter]
+        heapq.heappush(self.queue, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), queue_timeout)
+            return memory_mb
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # Admitted just as we gave up: a timeout still runs, a cancellation hands the slot back
+                if isinstance(e, asyncio.TimeoutError):
+                    return memory_mb
+                self.release(memory_mb)
+                raise
+            waiter.cancel()
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            # The removed entry may have been blocking smaller requests behind it
+            self.dispatch()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise HTTPException(
+                status_code=503,
+                detail=f"No execution slot became free within {queue_timeout:g} seconds",
+                headers={"Retry-After": self.retry_after()}
+            )
+    
+    def release(self, memory_mb: int, duration: Optional[float] = None) -> None:
+        self.running -= 1
+        self.memory_reserved_mb -= memory_mb
+        if duration is not None:
+            self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+        self.dispatch()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "max_concurrent": self.max_concurrent,
+            "memory_reserved_mb": self.memory_reserved_mb,
+            "memory_budget_mb": self.memory_budget_mb,
+            "queued": len(self.queue),
+            "max_queue_depth": self.max_queue_depth,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
+
+admission = AdmissionController(MAX_CONCURRENT_EXECUTIONS, EXECUTION_MEMORY_BUDGET_MB, MAX_QUEUE_DEPTH)
+
+class CpuAllocator:
+    """Splits the cores between running executions so that their thread pools do not oversubscribe them.
+    
+    An execution's thread budget is its fair share of the cores given how many executions are
+    running, capped by its cpu_limit. With pinning on it also gets that many of the cores fewest
+    running executions are pinned to.
+    """
+    
+    def __init__(self, cores: List[int], pin: bool):
+        self.cores = cores
+        self.pin = pin
+        self.users = {core: 0 for core in cores}
+    
+    def assign(self, cpu_limit: Optional[int], running: int) -> tuple[int, Optional[List[int]]]:
+        threads = max(1, len(self.cores) // max(1, running))
+        if cpu_limit:
+            threads = min(threads, cpu_limit)
+        if not self.pin:
+            return threads, None
+        cores = sorted(sorted(self.cores, key=lambda core: self.users[core])[:threads])
+        for core in cores:
+            self.users[core] += 1
+        return threads, cores
+    
+    def release(self, cores: Optional[List[int]]) -> None:
+        for core in cores or []:
+            self.users[core] -= 1
+
+cpu_allocator = CpuAllocator(CPU_CORES, CPU_AFFINITY)
+
+def request_priority(request: CodeExecutionRequest) -> str:
+    if request.priority:
+        return request.priority
+    return "interactive" if request.timeout <= INTERACTIVE_TIMEOUT_SECONDS else "batch"
+
+class ExecutionRegistry:
+    """Executions that are queued or running, by id, so that they can be cancelled from another request."""
+    
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.cancelled: Set[str] = set()
+    
+    async def run(self, execution_id: str, execution: Awaitable[Dict[str, Any]]) -> Dict[str, Any]:
+        """Await execution as a task registered under execution_id.
+        
+        If it is cancelled through cancel() a failed result is returned; if the caller itself is
+        cancelled (e.g. the client disconnected) the cancellation propagates as usual.
+        """
+        if execution_id in self.tasks:
+            execution.close()
+            raise HTTPException(status_code=409, detail=f"Execution {execution_id} is already running")
+        started = time.perf_counter()
+        task = asyncio.ensure_future(execution)
+        self.tasks[execution_id] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if execution_id not in self.cancelled:
+                raise
+            return {**failed_result("Execution cancelled", time.perf_counter() - started), "execution_id": execution_id}
+        finally:
+            del self.tasks[execution_id]
+            self.cancelled.discard(execution_id)
+    
+    def cancel(self, execution_id: str) -> Optional[asyncio.Task]:
+        """Cancel an execution, returning its task to await, or None if it is not running."""
+        task = self.tasks.get(execution_id)
+        if task is None or task.done():
+            return None
+        self.cancelled.add(execution_id)
+        task.cancel()
+        return task
     
+    async def cancel_all(self) -> None:
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+executions = ExecutionRegistry()
+
+async def run_execution(request: CodeExecutionRequest, **options) -> Dict[str, Any]:
+    """Run a request through execute_code_safely once the admission controller lets it in.
+    
+    The execution is registered under request.execution_id (or a new id) while it is queued
+    or running, so that DELETE /executions/{id} can stop it.
+    """
+    execution_id = request.execution_id or uuid.uuid4().hex
+    return await executions.run(execution_id, admit_and_execute(request, execution_id, **options))
+
+async def admit_and_execute(request: CodeExecutionRequest, execution_id: str, **options) -> Dict[str, Any]:
+    datasets = dataset_store.resolve(request.datasets)
+    queued_at = time.perf_counter()
+    reserved_mb = await admission.acquire(
+        options.get("memory_limit_mb", request.memory_limit_mb),
+        request_priority(request),
+        QUEUE_TIMEOUT_SECONDS if request.queue_timeout is None else request.queue_timeout
+    )
+    queue_wait = time.perf_counter() - queued_at
+    QUEUE_WAIT_SECONDS.observe(queue_wait)
+    cpu_threads, cpu_cores = cpu_allocator.assign(request.cpu_limit, admission.running)
+    duration = None
     try:
-        result = await execute_code_safely(
+        execution_options = dict(
             code=request.code,
             timeout=request.timeout,
-            memory_limit_mb=request.memory_limit_mb
+            memory_limit_mb=request.memory_limit_mb,
+            plot_format=request.plot_format,
+            plot_dpi=request.plot_dpi,
+            plot_max_pixels=request.plot_max_pixels,
+            plot_max_bytes=request.plot_max_bytes,
+            rich_output=request.rich_output,
+            max_rich_outputs=request.max_rich_outputs,
+            max_plots=request.max_plots,
+            inline_plots=request.inline_plots,
+            max_output_bytes=request.max_output_bytes,
+            spill_output=request.spill_output,
+            datasets=datasets,
+            profile=request.profile,
+            profile_top_n=request.profile_top_n,
+            profile_flamegraph=request.profile_flamegraph,
+            cpu_threads=cpu_threads,
+            cpu_cores=cpu_cores
         )
-        
-        return CodeExecutionResponse(
-            success=result["success"],
-            output=result["output"],
-            error=result["error"],
-            execution_time=result["execution_time"],
-            memory_used_mb=result["memory_used_mb"],
-            timestamp=datetime.now().isoformat(),
-            plots=result["plots"]
+        execution_options.update(options)
+        result = await execute_code_safely(**execution_options)
+        result["execution_id"] = execution_id
+        duration = result["execution_time"]
+        if result.get("timings") is not None:
+            result["timings"]["queue_wait"] = queue_wait
+        return result
+    finally:
+        cpu_allocator.release(cpu_cores)
+        admission.release(reserved_mb, duration)
+
+def failed_result(error: str, execution_time: float = 0.0) -> Dict[str, Any]:
+    return {
+        "success": False,
+        "output": "",
+        "error": error,
+        "execution_time": execution_time,
+        "memory_used_mb": None,
+        "peak_memory_mb": None,
+        "memory_limit_exceeded": False,
+        "plots": None,
+        "plot_artifacts": None
+    }
+
+def build_response(result: Dict[str, Any]) -> CodeExecutionResponse:
+    return CodeExecutionResponse(
+        execution_id=result.get("execution_id"),
+        success=result["success"],
+        output=result["output"],
+        error=result["error"],
+        execution_time=result["execution_time"],
+        memory_used_mb=result["memory_used_mb"],
+        peak_memory_mb=result["peak_memory_mb"],
+        unique_memory_mb=result.get("unique_memory_mb"),
+        shared_memory_mb=result.get("shared_memory_mb"),
+        memory_limit_exceeded=result["memory_limit_exceeded"],
+        cpu_time_seconds=result.get("cpu_time_seconds"),
+        cpu_threads=result.get("cpu_threads"),
+        cpu_cores=result.get("cpu_cores"),
+        timestamp=datetime.now().isoformat(),
+        plots=result["plots"],
+        plot_artifacts=result["plot_artifacts"],
+        truncated=result.get("truncated", False),
+        output_bytes=result.get("output_bytes"),
+        error_bytes=result.get("error_bytes"),
+        output_artifacts=result.get("output_artifacts"),
+        security_violations=result.get("security_violations"),
+        timings=result.get("timings"),
+        error_details=result.get("error_details"),
+        plot_metadata=result.get("plot_metadata"),
+        rich_outputs=result.get("rich_outputs"),
+        profile=result.get("profile")
+    )
+
+async def run_cached_execution(request: CodeExecutionRequest) -> CodeExecutionResponse:
+    """Run a request, going through the result cache when it opted in."""
+    if not request.cache:
+        return build_response(await run_execution(request))
+    
+    key = result_cache.key_for(request)
+    cached = result_cache.get(key)
+    if cached is None and key in result_cache.inflight:
+        cached = await asyncio.shield(result_cache.inflight[key])
+    if cached is not None:
+        result_cache.hits += 1
+        # Shallow copy: plot data is shared with the cached entry, not duplicated. Nothing ran
+        # here, so the cached run's execution_id is replaced by the one this request asked for
+        return cached.model_copy(update={"cache_hit": True, "timestamp": datetime.now().isoformat(),
+                                         "execution_id": request.execution_id})
+    
+    result_cache.misses += 1
+    inflight = asyncio.get_running_loop().create_future()
+    result_cache.inflight[key] = inflight
+    response = None
+    try:
+        response = build_response(await run_execution(request))
+        if result_cache.cacheable(response):
+            result_cache.put(key, response)
+        return response
+    finally:
+        # Requests that woke up to an uncacheable result run on their own and may have
+        # registered their run in the meantime; only remove this run's own entry
+        if result_cache.inflight.get(key) is inflight:
+            del result_cache.inflight[key]
+        inflight.set_result(response if response is not None and result_cache.cacheable(response) else None)
+
+class JobStore:
+    """Durable queue of execution jobs in SQLite, drained by a fixed number of background workers.
+    
+    Jobs and their results outlive the request that submitted them, and queued or interrupted
+    jobs survive a restart. Finished jobs are deleted ttl_seconds after they finish.
+    """
+    
+    FINISHED = ("completed", "failed", "cancelled")
+    
+    def __init__(self, path: str, workers: int, ttl_seconds: int, max_pending: int):
+        self.path = path
+        self.workers = workers
+        self.ttl_seconds = ttl_seconds
+        self.max_pending = max_pending
+        self.connection: Optional[sqlite3.Connection] = None
+        # One connection shared by the threads the queries run in
+        self.lock = threading.Lock()
+        self.wakeup = asyncio.Event()
+        self.waiters: Dict[str, asyncio.Event] = {}
+        self.cancel_requested: Set[str] = set()
+        self.tasks: List[asyncio.Task] = []
+    
+    def open(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at)")
+            # Jobs that were running when the server stopped are run again
+            self.connection.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+    
+    def query(self, sql: str, params: tuple = ()) -> tuple[List[tuple], int]:
+        """Run one statement in its own transaction, returning its rows and row count."""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(sql, params)
+            return cursor.fetchall(), cursor.rowcount
+    
+    def counts(self) -> Dict[str, int]:
+        rows, _ = self.query("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return dict(rows)
+    
+    def insert(self, jobs: List[tuple[str, str]]) -> None:
+        now = time.time()
+        with self.lock, self.connection:
+            pending = self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+            if pending + len(jobs) > self.max_pending:
+                raise HTTPException(status_code=429, detail=f"Too many pending jobs ({pending}); try again later",
+                                    headers={"Retry-After": admission.retry_after()})
+            try:
+                self.connection.executemany(
+                    "INSERT INTO jobs (id, status, request, created_at) VALUES (?, 'queued', ?, ?)",
+                    [(job_id, request, now) for job_id, request in jobs]
+                )
+            except sqlite3.IntegrityError:
+                raise HTTPException(status_code=409, detail="A job with this execution_id already exists")
+    
+    def claim_next(self) -> Optional[tuple[str, str]]:
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT id, request FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row:
+                self.connection.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), row[0]))
+            return row
+    
+    async def submit(self, requests: List[CodeExecutionRequest]) -> List[JobInfo]:
+        jobs = []
+        for request in requests:
+            job_id = request.execution_id or uuid.uuid4().hex
+            # Jobs queue behind interactive requests and wait as long as admission allows
+            request = request.model_copy(update={
+                "execution_id": job_id,
+                "priority": request.priority or "batch",
+                "queue_timeout": 300 if request.queue_timeout is None else request.queue_timeout
+            })
+            jobs.append((job_id, request.model_dump_json()))
+        await asyncio.to_thread(self.insert, jobs)
+        self.wakeup.set()
+        return [await self.get(job_id) for job_id, _ in jobs]
+    
+    async def get(self, job_id: str, wait: float = 0) -> Optional[JobInfo]:
+        """Look up a job; with wait, block up to that many seconds for it to finish first."""
+        job = await asyncio.to_thread(self.load, job_id)
+        if job is None or job.status in self.FINISHED or wait <= 0:
+            return job
+        finished = self.waiters.setdefault(job_id, asyncio.Event())
+        # Read again: the job may have finished before the waiter was registered
+        job = await asyncio.to_thread(self.load, job_id)
+        if job is None or job.status in self.FINISHED:
+            return job
+        try:
+            await asyncio.wait_for(finished.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+        return await asyncio.to_thread(self.load, job_id)
+    
+    def load(self, job_id: str) -> Optional[JobInfo]:
+        rows, _ = self.query(
+            "SELECT id, status, result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?", (job_id,)
         )
+        if not rows:
+            return None
+        job_id, status, result, error, created_at, started_at, finished_at = rows[0]
+        timestamp = lambda value: datetime.fromtimestamp(value).isoformat() if value else None
+        return JobInfo(
+            job_id=job_id,
+            status=status,
+            created_at=timestamp(created_at),
+            started_at=timestamp(started_at),
+            finished_at=timestamp(finished_at),
+            result=CodeExecutionResponse.model_validate_json(result) if result else None,
+            error=error
+        )
+    
+    async def finish(self, job_id: str, status: str, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        await asyncio.to_thread(
+            self.query,
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, result, error, time.time(), job_id)
+        )
+        finished = self.waiters.pop(job_id, None)
+        if finished:
+            finished.set()
+    
+    async def cancel(self, job_id: str) -> Optional[str]:
+        """Cancel a queued or running job, or delete a finished one. Returns what was done."""
+        job = await self.get(job_id)
+        if job is None:
+            return None
+        if job.status == "queued":
+            _, changed = await asyncio.to_thread(
+                self.query,
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            )
+            if changed:
+                finished = self.waiters.pop(job_id, None)
+                if finished:
+                    finished.set()
+                return "cancelled"
+            # Claimed by a worker in the meantime
+        if job.status in self.FINISHED:
+            await asyncio.to_thread(self.query, "DELETE FROM jobs WHERE id = ?", (job_id,))
+            return "deleted"
+        self.cancel_requested.add(job_id)
+        task = executions.cancel(job_id)
+        if task:
+            await asyncio.wait({task})
+        return "cancelled"
+    
+    async def work(self) -> None:
+        while True:
+            self.wakeup.clear()
+            job = await asyncio.to_thread(self.claim_next)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run_job(*job)
+    
+    async def run_job(self, job_id: str, request_json: str) -> None:
+        try:
+            response = await run_cached_execution(CodeExecutionRequest.model_validate_json(request_json))
+        except HTTPException as e:
+            if e.status_code in (429, 503):
+                # Admission is saturated; put the job back and try again later
+                await asyncio.to_thread(self.query, "UPDATE jobs SET status = 'queued', started_at = NULL WHERE id = ?", (job_id,))
+                await asyncio.sleep(int(e.headers.get("Retry-After", 1)))
+                return
+            await self.finish(job_id, "failed", error=str(e.detail))
+            return
+        except asyncio.CancelledError:
+            # The server is shutting down; run the job again after the restart
+            self.query("UPDATE jobs SET status = 'queued', started_at = NULL WHERE id = ?", (job_id,))
+            raise
+        except Exception as e:
+            logger.error(f"Error running job {job_id}: {str(e)}")
+            await self.finish(job_id, "failed", error=f"Internal server error: {str(e)}")
+            return
+        status = "cancelled" if job_id in self.cancel_requested else "completed"
+        self.cancel_requested.discard(job_id)
+        await self.finish(job_id, status, result=response.model_dump_json())
+    
+    def sweep(self) -> None:
+        """Delete jobs that finished more than ttl_seconds ago."""
+        self.query("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (time.time() - self.ttl_seconds,))
+    
+    async def start(self) -> None:
+        await asyncio.to_thread(self.open)
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+    
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.connection:
+            self.connection.close()
+
+job_store = JobStore(JOBS_DB_PATH, JOB_WORKERS, JOB_TTL_SECONDS, MAX_PENDING_JOBS)
+
+async def wait_for_disconnect(http_request: Request) -> None:
+    # The body has been read already, so the next message only arrives when the client goes away
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+async def cancel_on_disconnect(http_request: Request, work: Awaitable[Any]) -> Any:
+    """Await work, cancelling it (and so stopping its scripts) if the client disconnects first."""
+    task = asyncio.ensure_future(work)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({task, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        CLIENT_DISCONNECTS_TOTAL.inc()
+        logger.info("Client disconnected, cancelling its execution")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # Nobody is listening any more; 499 is the conventional "client closed request" status
+        return Response(status_code=499)
+    finally:
+        disconnect.cancel()
+        if not task.done():
+            task.cancel()
+
+@app.post("/execute", response_model=CodeExecutionResponse)
+async def execute_code(request: CodeExecutionRequest, http_request: Request):
+    """Execute Python code in a secure sandbox environment."""
+    
+    logger.info(f"Executing code with timeout: {request.timeout}s, memory limit: {request.memory_limit_mb}MB")
+    
+    try:
+        return encode_response(http_request, await cancel_on_disconnect(http_request, run_cached_execution(request)))
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error executing code: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-@app.get("/libraries")
-async def get_available_libraries():
-    """Get list of available libraries in the sandbox."""
-    
-    # Core libraries for data analysis and Google Cloud
-    libraries = [
-        {"name": "pandas", "description": "Data manipulation and analysis"},
-        {"name": "numpy", "description": "Numerical computing"},
-        {"name": "scipy", "description": "Scientific computing"},
-        {"name": "scikit-learn", "description": "Machine learning"},
-        {"name": "matplotlib", "description": "Plotting and visualization"},
-        {"name": "seaborn", "description": "Statistical data visualization"},
-        {"name": "plotly", "description": "Interactive visualizations"},
-        {"name": "google-cloud-storage", "description": "Google Cloud Storage client"},
-        {"name": "google-cloud-firestore", "description": "Google Cloud Firestore client"},
-        {"name": "google-cloud-bigquery", "description": "Google Cloud BigQuery client"},
-        {"name": "google-cloud-logging", "description": "Google Cloud Logging client"},
-        {"name": "requests", "description": "HTTP library"},
-        {"name": "json", "description": "JSON encoder and decoder"},
-        {"name": "datetime", "description": "Date and time handling"},
-        {"name": "math", "description": "Mathematical functions"},
-        {"name": "random", "description": "Random number generation"},
-        {"name": "statistics", "description": "Statistical functions"},
-        {"name": "collections", "description": "Specialized container datatypes"},
-        {"name": "itertools", "description": "Iterator functions"},
-        {"name": "functools", "description": "Higher-order functions"},
+def format_stream_event(event: str, payload: Dict[str, Any], sse: bool) -> str:
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+    return json.dumps({"event": event, **payload}) + "\n"
+
+@app.post("/execute/stream")
+async def execute_code_stream(request: CodeExecutionRequest, http_request: Request):
+    """Execute Python code and stream stdout/stderr, plots, memory samples and the final result.
+    
+    Events are sent as NDJSON, or as Server-Sent Events if the client accepts text/event-stream.
+    Plots are always delivered as artifact references.
+    """
+    
+    logger.info(f"Streaming code execution with timeout: {request.timeout}s, memory limit: {request.memory_limit_mb}MB")
+    
+    sse = "text/event-stream" in http_request.headers.get("accept", "")
+    # Known before the first event, so the client can cancel with DELETE /executions/{id}
+    request = request.model_copy(update={"execution_id": request.execution_id or uuid.uuid4().hex})
+    # Bounded so a slow client pauses the script instead of buffering its output here
+    events: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    
+    async def emit(event: str, payload: Dict[str, Any]) -> None:
+        await events.put((event, payload))
+    
+    async def run() -> None:
+        cancelled = False
+        try:
+            result = await run_execution(request, inline_plots=False, on_event=emit, capture_output=False)
+            await events.put(("result", build_response(result).model_dump()))
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except HTTPException as e:
+            # Only the 503 for a full queue carries Retry-After
+            retry_after = (e.headers or {}).get("Retry-After")
+            await events.put(("error", {"detail": e.detail, "status_code": e.status_code, "retry_after": int(retry_after) if retry_after else None}))
+        except Exception as e:
+            logger.error(f"Error executing code: {str(e)}")
+            await events.put(("error", {"detail": f"Internal server error: {str(e)}"}))
+        finally:
+            # Once cancelled nobody reads the queue any more, and a full queue would block forever
+            if not cancelled:
+                await events.put(None)
+    
+    task = asyncio.create_task(run())
+    
+    async def cancel_on_stream_disconnect() -> None:
+        # The response may stop pulling events without closing the generator below, so the
+        # disconnect is watched on its own; otherwise a script stalled on a full queue runs on
+        await wait_for_disconnect(http_request)
+        if not task.done():
+            CLIENT_DISCONNECTS_TOTAL.inc()
+            logger.info("Client disconnected, cancelling its streaming execution")
+            task.cancel()
+    
+    watcher = asyncio.create_task(cancel_on_stream_disconnect())
+    
+    async def event_stream():
+        try:
+            while True:
+                item = await events.get()
+                if item is None:
+                    break
+                yield format_stream_event(*item, sse=sse)
+        finally:
+            watcher.cancel()
+            if not task.done():
+                task.cancel()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers={"X-Execution-Id": request.execution_id}
+    )
+
+async def run_batch(request: BatchExecutionRequest):
+    """Run a batch's items with bounded parallelism, yielding (index, response) as each finishes.
+    
+    Items still running or queued when the deadline passes are cancelled and reported as failed.
+    """
+    limiter = asyncio.Semaphore(request.parallelism)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + request.deadline
+    
+    async def run_item(item: CodeExecutionRequest) -> CodeExecutionResponse:
+        # Batch items queue behind interactive requests and may wait until the batch deadline
+        item = item.model_copy(update={
+            "priority": item.priority or "batch",
+            "queue_timeout": request.deadline if item.queue_timeout is None else item.queue_timeout
+        })
+        async with limiter:
+            try:
+                return await run_cached_execution(item)
+            except HTTPException as e:
+                return build_response(failed_result(e.detail))
+            except Exception as e:
+                logger.error(f"Error executing batch item: {str(e)}")
+                return build_response(failed_result(f"Internal server error: {str(e)}"))
+    
+    pending = {asyncio.create_task(run_item(item)): index for index, item in enumerate(request.items)}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max(0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                yield pending.pop(task), task.result()
+        
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for index in sorted(pending.values()):
+            yield index, build_response(failed_result(f"Batch deadline of {request.deadline} seconds exceeded"))
+        pending = {}
+    finally:
+        # Also reached when a streaming client disconnects
+        for task in pending:
+            task.cancel()
+
+@app.post("/execute/batch", response_model=BatchExecutionResponse)
+async def execute_batch(request: BatchExecutionRequest, http_request: Request):
+    """Execute many independent snippets in one request over the worker pool."""
+    
+    logger.info(f"Executing batch of {len(request.items)} item(s) with parallelism: {request.parallelism}, deadline: {request.deadline}s")
+    start_time = datetime.now()
+    
+    if request.stream:
+        async def result_stream():
+            async for index, response in run_batch(request):
+                yield json.dumps({"index": index, **response.model_dump()}) + "\n"
+        return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+    
+    results: List[Optional[CodeExecutionResponse]] = [None] * len(request.items)
+    
+    async def collect() -> None:
+        async for index, response in run_batch(request):
+            results[index] = response
+    
+    disconnected = await cancel_on_disconnect(http_request, collect())
+    if disconnected:
+        return disconnected
+    succeeded = sum(1 for response in results if response.success)
+    
+    return encode_response(http_request, BatchExecutionResponse(
+        results=results,
+        succeeded=succeeded,
+        failed=len(results) - succeeded,
+        total_time=(datetime.now() - start_time).total_seconds()
+    ))
+
+@app.post("/sessions", response_model=SessionInfo)
+async def create_session(request: SessionCreateRequest):
+    """Start a persistent sandboxed worker whose variables survive between executions."""
+    session = await session_manager.create(request.memory_limit_mb)
+    logger.info(f"Created session {session.id} with memory limit: {request.memory_limit_mb}MB")
+    return session.info()
+
+@app.get("/sessions/{session_id}", response_model=SessionInfo)
+async def get_session(session_id: str):
+    return session_manager.get(session_id).info()
+
+@app.post("/sessions/{session_id}/execute", response_model=CodeExecutionResponse)
+async def execute_in_session(session_id: str, request: CodeExecutionRequest, http_request: Request):
+    """Execute Python code in a session's namespace.
+    
+    The session's memory limit applies instead of memory_limit_mb. If the code times out
+    the session is terminated, since its state can no longer be trusted.
+    """
+    session = session_manager.get(session_id)
+    
+    logger.info(f"Executing code in session {session_id} with timeout: {request.timeout}s")
+    
+    async with session.lock:
+        if not session.worker.alive:
+            await session_manager.close(session_id)
+            raise HTTPException(status_code=410, detail="Session has terminated")
+        session.executions += 1
+        try:
+            result = await cancel_on_disconnect(http_request, run_execution(
+                request,
+                memory_limit_mb=session.memory_limit_mb,
+                worker=session.worker,
+                apply_memory_limit=False
+            ))
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error executing code: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+        finally:
+            session.last_used_at = datetime.now()
+    
+    if isinstance(result, Response):
+        # The client disconnected and its execution was stopped, which also ends the session
+        await session_manager.close(session_id)
+        return result
+    if not session.worker.alive or session.worker.process.returncode is not None:
+        await session_manager.close(session_id)
+        result["error"] = f"{result['error'] or 'Session worker exited'}; the session has been terminated"
+    return encode_response(http_request, build_response(result))
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Terminate a session and free its memory."""
+    session_manager.get(session_id)
+    await session_manager.close(session_id)
+    return {"session_id": session_id, "status": "closed"}
+
+@app.delete("/executions/{execution_id}")
+async def cancel_execution(execution_id: str):
+    """Cancel a queued or running execution.
+    
+    Its processes are stopped before this returns, and its own request completes with
+    "Execution cancelled".
+    """
+    task = executions.cancel(execution_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"Execution {execution_id} is not running")
+    CANCELLATIONS_TOTAL.inc()
+    await asyncio.wait({task})
+    logger.info(f"Cancelled execution {execution_id}")
+    return {"execution_id": execution_id, "status": "cancelled"}
+
+@app.post("/jobs", response_model=JobInfo, status_code=202)
+async def submit_job(request: CodeExecutionRequest, response: Response):
+    """Queue an execution and return at once; poll GET /jobs/{id} for the result."""
+    job = (await job_store.submit([request]))[0]
+    logger.info(f"Queued job {job.job_id} with timeout: {request.timeout}s")
+    response.headers["Location"] = f"/jobs/{job.job_id}"
+    return job
+
+@app.post("/jobs/batch", response_model=List[JobInfo], status_code=202)
+async def submit_jobs(request: JobBatchRequest):
+    """Queue many executions at once; the server runs them at its own concurrency."""
+    jobs = await job_store.submit(request.items)
+    logger.info(f"Queued {len(jobs)} job(s)")
+    return jobs
+
+@app.get("/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str, http_request: Request, wait: float = Query(default=0, ge=0, le=JOB_MAX_WAIT_SECONDS)):
+    """Status of a job, with its result once finished. With wait, long-poll until it finishes."""
+    job = await job_store.get(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired")
+    return encode_response(http_request, job)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job, or delete a finished one and its stored result."""
+    outcome = await job_store.cancel(job_id)
+    if outcome is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired")
+    return {"job_id": job_id, "status": outcome}
+
+@app.post("/datasets", response_model=DatasetInfo)
+async def upload_dataset(file: UploadFile = File(...)):
+    """Upload a data file once and reference it from executions by its id."""
+    dataset = await asyncio.to_thread(dataset_store.store, file.file, file.filename)
+    logger.info(f"Stored dataset {dataset.id} ({dataset.name}, {dataset.size_bytes} bytes)")
+    dataset_store.schedule_conversion(dataset)
+    return dataset
+
+@app.get("/datasets", response_model=List[DatasetInfo])
+async def list_datasets():
+    return await asyncio.to_thread(dataset_store.list)
+
+@app.get("/datasets/{dataset_id}", response_model=DatasetInfo)
+async def get_dataset(dataset_id: str):
+    return dataset_store.get(dataset_id)
+
+@app.delete("/datasets/{dataset_id}")
+async def delete_dataset(dataset_id: str):
+    await asyncio.to_thread(dataset_store.delete, dataset_id)
+    return {"dataset_id": dataset_id, "status": "deleted"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Execution metrics in the Prometheus text exposition format."""
+    # SQLite behind the job store's lock; kept off the event loop
+    job_counts = await asyncio.to_thread(job_store.counts) if job_store.connection else {}
+    metrics = [
+        QUEUE_WAIT_SECONDS, SPAWN_SECONDS, USER_CODE_SECONDS, PLOT_ENCODE_SECONDS,
+        OUTPUT_PARSE_SECONDS, UNIQUE_MEMORY_BYTES, RESPONSE_SIZE_BYTES,
+        EXECUTIONS_TOTAL, TIMEOUTS_TOTAL, SECURITY_REJECTIONS_TOTAL, MEMORY_LIMIT_KILLS_TOTAL, CPU_SECONDS_TOTAL,
+        COMPRESSION_SAVED_BYTES_TOTAL,
+        CANCELLATIONS_TOTAL, CLIENT_DISCONNECTS_TOTAL, ORPHANS_KILLED_TOTAL,
+        Gauge("sandbox_inflight_executions", "Executions currently running", lambda: admission.running),
+        Gauge("sandbox_queued_executions", "Executions waiting for a slot", lambda: len(admission.queue)),
+        Gauge("sandbox_memory_reserved_mb", "Sum of memory_limit_mb of running executions", lambda: admission.memory_reserved_mb),
+        Counter("sandbox_admission_rejected_total", "Requests rejected because the queue was full", lambda: admission.rejected),
+        Counter("sandbox_admission_timed_out_total", "Requests that gave up waiting for a slot", lambda: admission.timed_out),
+        Gauge("sandbox_worker_pool_size", "Configured number of pre-warmed workers", lambda: worker_pool.size if worker_pool else 0),
+        Gauge("sandbox_worker_pool_idle", "Pre-warmed workers ready for an execution", lambda: len(worker_pool.idle) if worker_pool else 0),
+        Gauge("sandbox_worker_pool_busy", "Pre-warmed workers running an execution", lambda: worker_pool.busy if worker_pool else 0),
+        Gauge("sandbox_sessions", "Open sessions", lambda: len(session_manager.sessions)),
+        Gauge("sandbox_jobs_queued", "Jobs waiting for a job worker", lambda: job_counts.get("queued", 0)),
+        Gauge("sandbox_jobs_running", "Jobs being run by job workers", lambda: job_counts.get("running", 0)),
+        Gauge("sandbox_result_cache_entries", "Entries in the result cache", lambda: len(result_cache.entries)),
+        Counter("sandbox_result_cache_hits_total", "Result cache hits", lambda: result_cache.hits),
+        Counter("sandbox_result_cache_misses_total", "Result cache misses", lambda: result_cache.misses),
     ]
+    body = "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Hit/miss statistics of the result cache."""
+    return result_cache.stats()
+
+@app.get("/artifacts/{artifact_id:path}")
+async def get_artifact(artifact_id: str):
+    """Stream a plot artifact produced by an execution."""
+    if not ARTIFACT_ID_PATTERN.match(artifact_id):
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    path = os.path.join(ARTIFACTS_DIR, artifact_id)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    media_type = ARTIFACT_MEDIA_TYPES.get(artifact_id.rsplit('.', 1)[-1], "application/octet-stream")
+    return FileResponse(path, media_type=media_type)
+
+@app.get("/libraries")
+async def get_available_libraries(request: Request, check: Optional[str] = None):
+    """List the installed packages with their versions, or answer ?check=name1,name2 importability.
     
-    return {
-        "available_libraries": libraries,
-        "total_count": len(libraries),
-        "note": "This list includes major libraries. Standard Python libraries are also available."
+    The list supports conditional GETs: send the ETag back in If-None-Match to get a 304.
+    """
+    if library_catalog.libraries is None:
+        await asyncio.to_thread(library_catalog.load)
+    
+    if check is not None:
+        names = [name.strip() for name in check.split(",") if name.strip()][:100]
+        return {"check": {name: library_catalog.check(name) for name in names}}
+    
+    headers = {
+        "ETag": library_catalog.etag,
+        "Cache-Control": f"public, max-age={LIBRARIES_MAX_AGE_SECONDS}"
     }
+    if library_catalog.etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=library_catalog.body, media_type="application/json", headers=headers)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
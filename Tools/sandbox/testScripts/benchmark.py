@@ -0,0 +1,291 @@
+"""
+Benchmark and load test for the Code Runner Sandbox API
+
+Starts the app on localhost (or targets --url), runs standard workloads at the
+requested concurrency levels and prints latency percentiles, throughput, peak
+memory and error rate as JSON.
+
+    python testScripts/benchmark.py --concurrency 1,4,8 --requests 40 --output bench.json
+    python testScripts/benchmark.py --baseline bench.json   # exit 1 on regressions
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psutil
+import requests
+
+SANDBOX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKLOADS = {
+    "hello": {
+        "code": 'print("Hello from the sandbox!")',
+        "timeout": 10,
+    },
+    "pandas_groupby": {
+        "code": """
+import numpy as np
+import pandas as pd
+
+rng = np.random.default_rng(42)
+data = pd.DataFrame({
+    'group': rng.integers(0, 100, 200_000),
+    'value': rng.normal(size=200_000),
+})
+print(data.groupby('group')['value'].agg(['mean', 'std', 'count']).head())
+""",
+        "timeout": 30,
+    },
+    "sklearn_fit": {
+        "code": """
+from sklearn.datasets import make_classification
+from sklearn.linear_model import LogisticRegression
+
+X, y = make_classification(n_samples=5_000, n_features=20, random_state=42)
+model = LogisticRegression(max_iter=500).fit(X, y)
+print(f"Accuracy: {model.score(X, y):.3f}")
+""",
+        "timeout": 30,
+    },
+    "multi_plot": {
+        "code": """
+import matplotlib.pyplot as plt
+import numpy as np
+
+x = np.linspace(0, 10, 500)
+for i in range(4):
+    plt.figure()
+    plt.plot(x, np.sin(x * (i + 1)))
+    plt.title(f"Plot {i}")
+""",
+        "timeout": 30,
+    },
+    "large_output": {
+        "code": """
+for i in range(100_000):
+    print(f"line {i}: " + "x" * 40)
+""",
+        "timeout": 30,
+    },
+    "timeout": {
+        "code": "import time\ntime.sleep(10)",
+        "timeout": 1,
+        "expect_success": False,
+        "expect_error": "timed out",
+    },
+}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(port):
+    """Start the app with uvicorn on localhost and wait until /health answers."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=SANDBOX_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            health = requests.get(f"{url}/health", timeout=1).json()
+            pool = health.get("worker_pool")
+            # Wait for the pre-warmed workers too, so the first workload is not measured cold
+            if not pool or pool["idle"] >= pool["size"]:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.kill()
+    raise RuntimeError("Server did not become healthy within 60 seconds")
+
+class MemorySampler:
+    """Samples the total RSS of a process and all its descendants in a background thread."""
+
+    def __init__(self, pid, interval=0.1):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        total = 0
+        for process in [self.process] + self.process.children(recursive=True):
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak_bytes = max(self.peak_bytes, total)
+
+    def run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_bytes = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+def run_request(session, url, workload):
+    """Send one execution and return (latency_seconds, ok, error_description)."""
+    started = time.perf_counter()
+    try:
+        response = session.post(f"{url}/execute", json={
+            "code": workload["code"],
+            "timeout": workload["timeout"],
+        }, timeout=workload["timeout"] + 60)
+    except requests.RequestException as e:
+        return time.perf_counter() - started, False, str(e)
+    latency = time.perf_counter() - started
+    if response.status_code != 200:
+        return latency, False, f"HTTP {response.status_code}"
+    data = response.json()
+    if data["success"] != workload.get("expect_success", True):
+        return latency, False, (data.get("error") or "unexpected success")[:200]
+    if workload.get("expect_error") and workload["expect_error"] not in (data.get("error") or ""):
+        return latency, False, (data.get("error") or "")[:200]
+    return latency, True, None
+
+def run_workload(url, name, workload, concurrency, total_requests, sampler):
+    local = threading.local()
+
+    def send(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return run_request(local.session, url, workload)
+
+    # Without a local server process (--url) there is nothing to sample
+    with sampler or contextlib.nullcontext():
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(send, range(total_requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _, _ in outcomes)
+    errors = [error for _, ok, error in outcomes if not ok]
+    return {
+        "workload": name,
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": len(errors),
+        "error_rate": round(len(errors) / total_requests, 4),
+        "sample_errors": sorted(set(errors))[:3],
+        "requests_per_second": round(total_requests / elapsed, 3),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2),
+        },
+        "peak_memory_mb": round(sampler.peak_bytes / 1024 / 1024, 1) if sampler else None,
+    }
+
+def compare(results, baseline, tolerance):
+    """List the runs whose p95 latency or throughput got worse than the baseline by more than tolerance."""
+    previous = {(run["workload"], run["concurrency"]): run for run in baseline["results"]}
+    regressions = []
+    for run in results:
+        before = previous.get((run["workload"], run["concurrency"]))
+        if not before:
+            continue
+        if run["latency_ms"]["p95"] > before["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{run['workload']} x{run['concurrency']}: p95 {before['latency_ms']['p95']} -> {run['latency_ms']['p95']} ms")
+        if run["requests_per_second"] < before["requests_per_second"] * (1 - tolerance):
+            regressions.append(f"{run['workload']} x{run['concurrency']}: {before['requests_per_second']} -> {run['requests_per_second']} req/s")
+        if run["error_rate"] > before["error_rate"]:
+            regressions.append(f"{run['workload']} x{run['concurrency']}: error rate {before['error_rate']} -> {run['error_rate']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="Comma-separated workloads to run")
+    parser.add_argument("--concurrency", default="1,4", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per workload and concurrency level")
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured requests per workload before measuring")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.workloads.split(",") if name.strip()]
+    unknown = [name for name in names if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workload(s): {', '.join(unknown)}; choose from {', '.join(WORKLOADS)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    server = None
+    url = args.url.rstrip("/") if args.url else None
+    if not url:
+        server, url = start_server(free_port())
+    sampler = MemorySampler(server.pid) if server else None
+
+    results = []
+    try:
+        for name in names:
+            workload = WORKLOADS[name]
+            with requests.Session() as session:
+                for _ in range(args.warmup):
+                    run_request(session, url, workload)
+            for concurrency in levels:
+                print(f"⏱️  {name} x{concurrency}...", file=sys.stderr)
+                results.append(run_workload(url, name, workload, concurrency, args.requests, sampler))
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "url": args.url or "local",
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "requests_per_run": args.requests,
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report["regressions"] = compare(results, json.load(baseline_file), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    if report.get("regressions"):
+        print("⚠️ Regressions against the baseline:\n" + "\n".join(report["regressions"]), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()